@@ -1,91 +1,288 @@
 import uharfbuzz as hb
 from fontTools.ttLib import TTFont
 import sys
+import json
 from argparse import ArgumentParser
+from itertools import islice
+from multiprocessing import Pool
 import warnings
+from shapecache import ShapingCache, font_hash
+from failureclusters import FailureClusters
 
-parser = ArgumentParser(description="Compare shaping results for two fonts")
-parser.add_argument("file1", help="First font to compare", metavar="FILE1")
-parser.add_argument("file2", help="Second font to compare", metavar="FILE2")
-parser.add_argument("wordlist", help="File containing words", metavar="WORDLIST")
-parser.add_argument(
-    "--ignorables",
-    help="Glyph names to ignore in output (comma separated)",
-    metavar="GLYPHS",
-)
-parser.add_argument(
-    "--features",
-    help="OpenType feature string (+xxxx, -xxxx, comma separated)",
-    metavar="FEATURES",
-)
-args = parser.parse_args()
-
-ignorables = []
-if args.ignorables:
-    ignorables = args.ignorables.split(",")
-
-features = {}
-if args.features:
-    for f in args.features.split(","):
-        if f[0] == "+":
-            features[f[1:]] = True
-        elif f[0] == "-":
-            features[f[1:]] = True
-        else:
-            warnings.warn("Unable to parse feature '%s'" % f)
-
-
-def shaping_string(fontdata, glyphOrder, text, language=None):
-    face = hb.Face(fontdata)
-    font = hb.Font(face)
-    upem = face.upem
-    font.scale = (upem, upem)
-    hb.ot_font_set_funcs(font)
-
-    buf = hb.Buffer()
-
-    buf.add_str(text)
-    buf.guess_segment_properties()
-    if language:
-        buf.language = language
+CHUNK_SIZE = 1000
 
+
+def parse_features(feature_string):
     features = {"kern": True, "liga": True}
-    hb.shape(font, buf, features)
+    if feature_string:
+        for f in feature_string.split(","):
+            if f[0] == "+":
+                features[f[1:]] = True
+            elif f[0] == "-":
+                features[f[1:]] = False
+            else:
+                warnings.warn("Unable to parse feature '%s'" % f)
+    return features
+
+
+class ShapingFont:
+    """A font set up once for shaping many words with.
+
+    Args:
+        filename: The font file.
+        features: Dictionary of OpenType features to apply.
+        ignorables: Glyph names to leave out of the output.
+        cache: A ShapingCache, or None.
+    """
+
+    def __init__(self, filename, features, ignorables, cache=None):
+        with open(filename, "rb") as fontfile:
+            face = hb.Face(fontfile.read())
+        self.font = hb.Font(face)
+        upem = face.upem
+        self.font.scale = (upem, upem)
+        hb.ot_font_set_funcs(self.font)
+        self.buf = hb.Buffer()
+        self.features = features
+        self.glyph_names = TTFont(filename, lazy=True).getGlyphOrder()
+        self.ignorable = {
+            gid for gid, name in enumerate(self.glyph_names) if name in ignorables
+        }
+        self.cache = cache
+        self.fonthash = font_hash(filename) if cache else None
+
+    def shape(self, text, language=None):
+        # Returns the font's own buffer, so it is only valid until the next call
+        parameters = {"features": self.features, "language": language}
+        if self.cache:
+            buf = self.cache.get(self.fonthash, text, parameters)
+            if buf is not None:
+                return buf
+        buf = self.buf
+        buf.clear_contents()
+        buf.add_str(text)
+        buf.guess_segment_properties()
+        if language:
+            buf.language = language
+        hb.shape(self.font, buf, self.features)
+        if self.cache:
+            self.cache.put(self.fonthash, text, parameters, buf)
+        return buf
+
+    def glyphs(self, text, glyph_ids, language=None):
+        """Returns the shaped text as a flat tuple of integers.
+
+        Each glyph not being ignored contributes its id in ``glyph_ids``,
+        its cluster and its x and y offsets."""
+        buf = self.shape(text, language)
+        ignorable = self.ignorable
+        glyphs = []
+        for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+            gid = info.codepoint
+            if gid in ignorable:
+                continue
+            glyphs.extend((glyph_ids[gid], info.cluster, pos.x_offset, pos.y_offset))
+        return tuple(glyphs)
 
-    infos = buf.glyph_infos
-    positions = buf.glyph_positions
+
+def shaping_string(glyphs, names):
     outs = []
-    for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
-        name = glyphOrder[info.codepoint]
-        if name in ignorables:
-            continue
-        outs.append("%s=%i" % (name, info.cluster))
-        if pos.position[0] != 0 or pos.position[1] != 0:
-            outs[-1] = outs[-1] + "<%i,%i>" % (pos.position[0], pos.position[1])
+    for i in range(0, len(glyphs), 4):
+        glyph_id, cluster, x_offset, y_offset = glyphs[i : i + 4]
+        outs.append("%s=%i" % (names[glyph_id], cluster))
+        if x_offset != 0 or y_offset != 0:
+            outs[-1] = outs[-1] + "<%i,%i>" % (x_offset, y_offset)
     return "|".join(outs)
 
 
-font1 = TTFont(args.file1)
-font2 = TTFont(args.file2)
-
-with open(args.file1, "rb") as fontfile:
-    fontdata1 = fontfile.read()
-with open(args.file2, "rb") as fontfile:
-    fontdata2 = fontfile.read()
-with open(args.wordlist, "r") as wordlist:
-    test_strings = wordlist.read().split()
-
-tested = 0
-passed = 0
-for test in test_strings:
-    ss1 = shaping_string(fontdata1, font1.getGlyphOrder(), test)
-    ss2 = shaping_string(fontdata2, font2.getGlyphOrder(), test)
-    tested += 1
-    if ss1 == ss2:
-        passed += 1
+class ShapeComparator:
+    """Shapes words with two fonts and compares the results.
+
+    Glyphs are compared by name, but to avoid looking names up for every
+    word, the second font's glyph IDs are translated up front into the
+    first font's (glyphs missing from the first font get IDs of their own).
+    The shaped glyphs of each word are then reduced to a flat tuple of
+    integers, and shaping strings are only built for words whose tuples
+    differ.
+    """
+
+    def __init__(self, file1, file2, features, ignorables, cache=None):
+        self.font1 = ShapingFont(file1, features, ignorables, cache)
+        self.font2 = ShapingFont(file2, features, ignorables, cache)
+        self.names = list(self.font1.glyph_names)
+        ids = {name: gid for gid, name in enumerate(self.names)}
+        self.glyph_ids1 = list(range(len(self.names)))
+        self.glyph_ids2 = []
+        for name in self.font2.glyph_names:
+            if name not in ids:
+                ids[name] = len(self.names)
+                self.names.append(name)
+            self.glyph_ids2.append(ids[name])
+
+    def compare(self, text, language=None):
+        """Returns whether the two fonts shape a text the same way.
+
+        Also returns the two shaping strings if they don't, or None if they do.
+        """
+        glyphs1 = self.font1.glyphs(text, self.glyph_ids1, language)
+        glyphs2 = self.font2.glyphs(text, self.glyph_ids2, language)
+        if glyphs1 == glyphs2:
+            return True, None, None
+        return (
+            False,
+            shaping_string(glyphs1, self.names),
+            shaping_string(glyphs2, self.names),
+        )
+
+
+def read_words(wordlist):
+    """Yields each distinct word in the word list, reading it lazily."""
+    seen = set()
+    with open(wordlist, "r") as fh:
+        for line in fh:
+            for word in line.split():
+                if word not in seen:
+                    seen.add(word)
+                    yield word
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Each worker process (or the main process, when running serially) keeps
+# its own comparator, holding both fonts.
+comparator = None
+
+
+def init_comparator(file1, file2, features, ignorables, use_cache):
+    global comparator
+    cache = ShapingCache() if use_cache else None
+    comparator = ShapeComparator(file1, file2, features, ignorables, cache)
+
+
+def compare_chunk(words):
+    """Returns the number of words compared, and the failures.
+
+    Each failure is (index in chunk, word, ss1, ss2)."""
+    failures = []
+    for index, word in enumerate(words):
+        same, ss1, ss2 = comparator.compare(word)
+        if not same:
+            failures.append((index, word, ss1, ss2))
+    # Worker processes don't run exit handlers, so don't leave this for close()
+    if comparator.font1.cache:
+        comparator.font1.cache.commit()
+    return len(words), failures
+
+
+def main():
+    parser = ArgumentParser(description="Compare shaping results for two fonts")
+    parser.add_argument("file1", help="First font to compare", metavar="FILE1")
+    parser.add_argument("file2", help="Second font to compare", metavar="FILE2")
+    parser.add_argument("wordlist", help="File containing words", metavar="WORDLIST")
+    parser.add_argument(
+        "--ignorables",
+        help="Glyph names to ignore in output (comma separated)",
+        metavar="GLYPHS",
+    )
+    parser.add_argument(
+        "--features",
+        help="OpenType feature string (+xxxx, -xxxx, comma separated)",
+        metavar="FEATURES",
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Don't use the persistent shaping cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of worker processes (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max-failures",
+        help="Stop after this many failing words",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--cluster",
+        help="Group failures by the glyphs that differ, instead of listing each one",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jsonl",
+        help="Output one JSON object per failure, then a summary object",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    ignorables = []
+    if args.ignorables:
+        ignorables = args.ignorables.split(",")
+    features = parse_features(args.features)
+
+    initargs = (args.file1, args.file2, features, ignorables, not args.no_cache)
+    chunks = chunked(read_words(args.wordlist), CHUNK_SIZE)
+    pool = None
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_comparator, initargs=initargs)
+        results = pool.imap(compare_chunk, chunks)
     else:
-        print("Shaping %s" % test)
-        print("With %s: %s" % (args.file1, ss1))
-        print("With %s: %s\n" % (args.file2, ss2))
+        init_comparator(*initargs)
+        results = map(compare_chunk, chunks)
+
+    tested = 0
+    failed = 0
+    stopped = False
+    clusters = FailureClusters()
+    for count, failures in results:
+        for index, test, ss1, ss2 in failures:
+            failed += 1
+            if args.cluster:
+                clusters.add(test, ss1, ss2)
+            elif args.jsonl:
+                print(json.dumps({"word": test, "font1": ss1, "font2": ss2}))
+            else:
+                print("Shaping %s" % test)
+                print("With %s: %s" % (args.file1, ss1))
+                print("With %s: %s\n" % (args.file2, ss2))
+            sys.stdout.flush()
+            if failed == args.max_failures:
+                tested += index + 1
+                stopped = True
+                break
+        if stopped:
+            break
+        tested += count
+
+    if pool:
+        pool.terminate()
+    passed = tested - failed
+    if args.cluster and args.jsonl:
+        for key, count, examples in clusters.groups():
+            differences = [{"font1": g1, "font2": g2} for g1, g2 in key]
+            print(
+                json.dumps(
+                    {"differences": differences, "count": count, "examples": examples}
+                )
+            )
+    elif args.cluster:
+        print("\n".join(clusters.report(args.file1, args.file2)))
+    if args.jsonl:
+        print(json.dumps({"tested": tested, "passed": passed, "failed": failed}))
+    else:
+        print("\n%i tests, %i passed, %i failing" % (tested, passed, failed))
+
 
-print("\n%i tests, %i passed, %i failing" % (tested, passed, tested - passed))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Group shaping mismatches by what actually differs between them.
+
+One broken lookup or kerning pair can make thousands of words fail. Each
+mismatch is reduced to a signature: the distinct runs of glyphs which differ
+between the two results. The results are cut wherever both of them start a
+new cluster, and the pieces which don't match make up the signature (without
+their cluster numbers, which depend on where in the word things happen). So
+``o=0|fi=1|v=3`` against ``o=0|f=1|i=2|v=3`` has the signature ``fi`` /
+``f|i``, as does every other word where that ligature is missing, however
+many times it is missing.
+
+Only a count and a few example words are kept per signature, so memory use
+depends on how many distinct problems there are, not on how many failures.
+"""
+import re
+
+
+def glyph_tokens(serialized):
+    """Splits a serialized buffer into (cluster, glyph) pairs.
+
+    The cluster is None if the serialization didn't include one."""
+    tokens = []
+    if not serialized:
+        return tokens
+    for token in serialized.split("|"):
+        m = re.match(r"^(.*?)=(\d+)(.*)$", token)
+        if m:
+            tokens.append((int(m[2]), m[1] + m[3]))
+        else:
+            tokens.append((None, token))
+    return tokens
+
+
+def split_at(tokens, boundaries):
+    pieces = []
+    for cluster, glyph in tokens:
+        if not pieces or cluster in boundaries:
+            pieces.append([])
+        pieces[-1].append(glyph)
+    return ["|".join(piece) for piece in pieces]
+
+
+def signature(serialized1, serialized2):
+    """Returns the differing runs as a tuple of (glyphs1, glyphs2) pairs."""
+    tokens1 = glyph_tokens(serialized1)
+    tokens2 = glyph_tokens(serialized2)
+    clusters1 = [cluster for cluster, _ in tokens1]
+    clusters2 = [cluster for cluster, _ in tokens2]
+    if None in clusters1 or None in clusters2:
+        # No clusters to line things up by; just trim the common ends.
+        glyphs1 = [glyph for _, glyph in tokens1]
+        glyphs2 = [glyph for _, glyph in tokens2]
+        while glyphs1 and glyphs2 and glyphs1[0] == glyphs2[0]:
+            glyphs1.pop(0)
+            glyphs2.pop(0)
+        while glyphs1 and glyphs2 and glyphs1[-1] == glyphs2[-1]:
+            glyphs1.pop()
+            glyphs2.pop()
+        return (("|".join(glyphs1), "|".join(glyphs2)),)
+    boundaries = set(clusters1) & set(clusters2)
+    pieces1 = split_at(tokens1, boundaries)
+    pieces2 = split_at(tokens2, boundaries)
+    if len(pieces1) != len(pieces2):
+        return (("|".join(pieces1), "|".join(pieces2)),)
+    hunks = {(p1, p2) for p1, p2 in zip(pieces1, pieces2) if p1 != p2}
+    return tuple(sorted(hunks))
+
+
+class FailureClusters:
+    """Collects mismatches into groups sharing a signature.
+
+    Args:
+        examples: How many example words to keep for each group.
+    """
+
+    def __init__(self, examples=3):
+        self.examples = examples
+        self.clusters = {}
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def add(self, word, serialized1, serialized2):
+        key = signature(serialized1, serialized2)
+        if key not in self.clusters:
+            self.clusters[key] = [0, []]
+        cluster = self.clusters[key]
+        cluster[0] += 1
+        if len(cluster[1]) < self.examples:
+            cluster[1].append(word)
+
+    def groups(self):
+        """Returns (signature, count, examples) for each group, commonest first."""
+        return sorted(
+            (
+                (key, count, examples)
+                for key, (count, examples) in self.clusters.items()
+            ),
+            key=lambda group: -group[1],
+        )
+
+    def report(self, label1, label2):
+        """Returns a list of lines describing each group."""
+        lines = [f"Differing glyphs ({label1} / {label2}):"]
+        for key, count, examples in self.groups():
+            if not key:
+                differences = "only cluster numbers differ"
+            else:
+                differences = "; ".join(
+                    f"{glyphs1 or '(nothing)'} / {glyphs2 or '(nothing)'}"
+                    for glyphs1, glyphs2 in key
+                )
+            lines.append(f"  {count} x {differences}  e.g. {' '.join(examples)}")
+        return lines
@@ -1,46 +1,182 @@
-import sys
+import struct
 from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables._g_l_y_f import (
+    ARG_1_AND_2_ARE_WORDS,
+    MORE_COMPONENTS,
+    WE_HAVE_A_SCALE,
+    WE_HAVE_A_TWO_BY_TWO,
+    WE_HAVE_AN_X_AND_Y_SCALE,
+)
+from multiprocessing import Pool
 import argparse
+import numpy as np
 
-parser = argparse.ArgumentParser(description="Finds deeply nested components")
-parser.add_argument(
-    "--depth", metavar="depth", type=int, default=2, help="minimum depth to report"
-)
-parser.add_argument("font", metavar="FONT", help="the font file to test")
-
-args = parser.parse_args()
-font = TTFont(args.font)
-
-if "glyf" not in font:
-    print("find-nested-components can only be used on TrueType fonts")
-
-nesting = {}
-
-
-def get_nesting(glyph):
-    if glyph in nesting:
-        return nesting[glyph]
-    gg = font["glyf"].glyphs[glyph]
-    components = gg.getComponentNames(font["glyf"])
-    if not components:
-        nesting[glyph] = {"depth": 0, "chain": []}
-        return nesting[glyph]
-    depth = 0
-    chain = []
-    for g in components:
-        nested = get_nesting(g)
-        if 1 + nested["depth"] > depth:
-            depth = 1 + nested["depth"]
-            chain = [g] + nested["chain"]
-    nesting[glyph] = {"depth": depth, "chain": chain}
-    return nesting[glyph]
-
-
-for glyph in font.getGlyphOrder():
-    if glyph not in nesting:
-        nesting[glyph] = get_nesting(glyph)
-
-for k, v in nesting.items():
-    if v["depth"] < args.depth:
-        continue
-    print("%s has depth %i: %s" % (k, v["depth"], " -> ".join([k] + v["chain"])))
+
+def outlines(font):
+    """Reads each glyph's contour and point counts, and each composite's
+    components, from the raw glyf table, without decompiling any glyphs.
+
+    Returns the contours and points of each simple glyph (zero for
+    composites), and a dictionary of composites' component glyph IDs."""
+    count = font["maxp"].numGlyphs
+    if font["head"].indexToLocFormat:
+        loca = np.frombuffer(font.reader["loca"], dtype=">u4", count=count + 1).astype(np.int64)
+    else:
+        loca = np.frombuffer(font.reader["loca"], dtype=">u2", count=count + 1).astype(np.int64) * 2
+    glyf = font.reader["glyf"]
+    data = np.frombuffer(glyf, dtype=np.uint8)
+    starts = loca[:-1]
+    present = loca[1:] > loca[:-1]
+
+    contours = np.zeros(count, dtype=np.int64)
+    contours[present] = data[starts[present, None] + np.arange(2)].view(">i2")[:, 0]
+    # A simple glyph's points are numbered up to the end of its last contour
+    points = np.zeros(count, dtype=np.int64)
+    simple = contours > 0
+    last_end = starts[simple] + 10 + 2 * (contours[simple] - 1)
+    points[simple] = (data[last_end].astype(np.int64) << 8 | data[last_end + 1]) + 1
+
+    components = {}
+    for gid in np.nonzero(contours < 0)[0]:
+        offset = starts[gid] + 10
+        found = []
+        while True:
+            flags, component = struct.unpack_from(">HH", glyf, offset)
+            found.append(component)
+            offset += 4
+            offset += 4 if flags & ARG_1_AND_2_ARE_WORDS else 2
+            if flags & WE_HAVE_A_SCALE:
+                offset += 2
+            elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+                offset += 4
+            elif flags & WE_HAVE_A_TWO_BY_TWO:
+                offset += 8
+            if not flags & MORE_COMPONENTS:
+                break
+        components[int(gid)] = found
+    contours[contours < 0] = 0
+    return contours, points, components
+
+
+def nesting(font):
+    """Works out every composite's depth, deepest chain of components and
+    flattened contour and point counts, components before composites.
+
+    Returns a dictionary mapping composites' glyph IDs to (depth, chain of
+    glyph IDs, contours, points)."""
+    contours, points, components = outlines(font)
+    contours, points = contours.tolist(), points.tolist()
+    depth = [0] * len(points)
+    deepest = [None] * len(points)
+    # 0 for glyphs not seen yet, 1 for composites whose components are
+    # still being worked out, 2 for glyphs which are done
+    state = [2] * len(points)
+    for gid in components:
+        state[gid] = 0
+
+    for root in components:
+        stack = [root]
+        while stack:
+            gid = stack[-1]
+            if state[gid] == 2:
+                stack.pop()
+                continue
+            if state[gid] == 0:
+                state[gid] = 1
+                for component in components[gid]:
+                    if state[component] == 1:
+                        raise ValueError(f"{font.getGlyphName(gid)} contains itself")
+                    if state[component] == 0:
+                        stack.append(component)
+                continue
+            # All of this composite's components are done
+            for component in components[gid]:
+                if depth[component] + 1 > depth[gid]:
+                    depth[gid] = depth[component] + 1
+                    deepest[gid] = component
+                contours[gid] += contours[component]
+                points[gid] += points[component]
+            state[gid] = 2
+            stack.pop()
+
+    found = {}
+    for gid in sorted(components):
+        chain = []
+        component = deepest[gid]
+        while component is not None:
+            chain.append(component)
+            component = deepest[component]
+        found[gid] = (depth[gid], chain, contours[gid], points[gid])
+    return found
+
+
+def analyse(filename):
+    """Returns a font's composites as (glyph name, depth, chain of glyph
+    names, contours, points), and its maxp limits; or an error message."""
+    font = TTFont(filename, lazy=True)
+    if "glyf" not in font:
+        return filename, "find-nested-components can only be used on TrueType fonts", None, None
+    try:
+        found = nesting(font)
+    except ValueError as e:
+        return filename, str(e), None, None
+    names = font.getGlyphOrder()
+    composites = [
+        (names[gid], depth, [names[component] for component in chain], contours, points)
+        for gid, (depth, chain, contours, points) in found.items()
+    ]
+    maxp = font["maxp"]
+    limits = (maxp.maxComponentDepth, maxp.maxCompositeContours, maxp.maxCompositePoints)
+    return filename, None, composites, limits
+
+
+def report(composites, limits, min_depth):
+    for name, depth, chain, contours, points in composites:
+        if depth < min_depth:
+            continue
+        print(
+            "%s has depth %i: %s (%i contours, %i points)"
+            % (name, depth, " -> ".join([name] + chain), contours, points)
+        )
+    if not composites:
+        return
+    most_contours = max(composites, key=lambda c: c[3])
+    most_points = max(composites, key=lambda c: c[4])
+    print(
+        "Most contours: %s (%i); most points: %s (%i); maxp says depth %i, %i contours, %i points"
+        % (most_contours[0], most_contours[3], most_points[0], most_points[4], *limits)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds deeply nested components")
+    parser.add_argument(
+        "--depth", metavar="depth", type=int, default=2, help="minimum depth to report"
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="number of worker processes (default: 1)"
+    )
+    parser.add_argument("fonts", metavar="FONT", nargs="+", help="the font files to test")
+
+    args = parser.parse_args()
+
+    pool = None
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap(analyse, args.fonts)
+    else:
+        results = map(analyse, args.fonts)
+
+    for filename, error, composites, limits in results:
+        if len(args.fonts) > 1:
+            print("==> %s <==" % filename)
+        if error:
+            print(error)
+        else:
+            report(composites, limits, args.depth)
+    if pool:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,20 +13,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import json
+import os
+import random
 import sys
 import textwrap
 from pathlib import Path
 from fontbakery.callable import check, condition
-from fontbakery.checkrunner import FAIL, PASS, SKIP, Section
+from fontbakery.checkrunner import FAIL, INFO, PASS, SKIP, Section
 from fontbakery.fonts_profile import profile_factory
+import uharfbuzz as hb
 from vharfbuzz import Vharfbuzz
 from os.path import basename, relpath
 from stringbrewer import StringBrewer
+from sre_yield import AllStrings
 from collidoscope import Collidoscope
 
+# fontbakery loads this profile by path, so make its helpers importable
+sys.path.insert(0, str(Path(__file__).parent))
+from parallelshaping import ShapingPool
+from shapecache import CachedShaper, ShapingCache
+from failureclusters import FailureClusters
+from lookupindex import LookupIndex
+
 shaping_basedir = Path("qa", "shaping_tests")
 
+# fontbakery profiles have no command line of their own, so tuning knobs
+# are taken from the environment. Set SHAPING_JOBS to the number of worker
+# processes to shape and collision-check pattern tests in parallel.
+shaping_jobs = int(os.environ.get("SHAPING_JOBS", "1"))
+
+# Patterns matching more strings than this are sampled. Tests (or the
+# configuration defaults) can override it with "max_strings", and choose
+# the sample with "seed".
+DEFAULT_MAX_STRINGS = 100_000
+
+# Beyond this many regression failures in a file, the check's message groups
+# them by what differs instead of listing every one.
+CLUSTER_FAILURES_OVER = 20
+
+# Shaping results are kept between runs in a cache (see shapecache.py).
+# SHAPING_CACHE may name the cache file to use, or be "off".
+shaping_cache = None
+
+
+def get_shaping_cache():
+    global shaping_cache
+    setting = os.environ.get("SHAPING_CACHE")
+    if setting == "off":
+        return None
+    if shaping_cache is None:
+        shaping_cache = ShapingCache(setting)
+    return shaping_cache
+
+
+# With SHAPING_INCREMENTAL=1, the lookups each test string depends on are
+# recorded in the test directory, and after a rebuild only strings which
+# could be affected by the lookups that changed are shaped again; the rest
+# come from the cache (see lookupindex.py). Incremental runs shape serially.
+shaping_incremental = os.environ.get("SHAPING_INCREMENTAL", "") not in ["", "0"]
+
 
 profile_imports = ()
 profile = profile_factory(default_section=Section("Shaping Checks"))
@@ -56,41 +103,218 @@ HTML_HEADER = """
     <body>
 """
 
-html_file = None
+HTML_FOOTER = """
+    </body>
+</html>
+"""
 
+REPORT_ITEMS_PER_PAGE = 500
+REPORT_MAX_SIZE = 50 * 1024 * 1024
+
+
+class HTMLReport:
+    """The HTML shaping report, written as failures are found.
+
+    Each glyph's outline is written once per page, into a hidden ``<defs>``
+    block, and drawings of shaped buffers refer to it with ``<use>``. Pages
+    hold at most ``items_per_page`` items (``report.html``, ``report-2.html``
+    and so on), and once roughly ``max_size`` characters have been written
+    further items are only counted.
+    """
+
+    def __init__(
+        self,
+        vharfbuzz,
+        basedir=shaping_basedir,
+        items_per_page=REPORT_ITEMS_PER_PAGE,
+        max_size=REPORT_MAX_SIZE,
+    ):
+        self.vharfbuzz = vharfbuzz
+        self.basedir = basedir
+        self.items_per_page = items_per_page
+        self.max_size = max_size
+        self.fontpath = relpath(Path(vharfbuzz.filename), basedir)
+        self.glyph_paths = {}
+        self.glyph_layers = {}
+        self.size = 0
+        self.omitted = 0
+        self.page = 0
+        self.file = None
+        # Don't leave pages from an earlier, longer report lying around
+        for stale in basedir.glob("report-*.html"):
+            stale.unlink()
+        self.open_page()
+        atexit.register(self.close)
+
+    @staticmethod
+    def page_name(page):
+        if page == 1:
+            return "report.html"
+        return f"report-{page}.html"
+
+    def write(self, text):
+        self.file.write(text)
+        self.size += len(text)
+
+    def open_page(self):
+        self.page += 1
+        self.file = open(self.basedir / self.page_name(self.page), "w")
+        self.items = 0
+        self.defined = set()
+        self.write(HTML_HEADER % self.fontpath)
+        if self.page > 1:
+            previous = self.page_name(self.page - 1)
+            self.write(f'<p><a href="{previous}">Previous page</a></p>\n')
+
+    def close_page(self, next_page=False):
+        if next_page:
+            following = self.page_name(self.page + 1)
+            self.write(f'<p><a href="{following}">Next page</a></p>\n')
+        self.write(HTML_FOOTER)
+        self.file.close()
+        self.file = None
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if not self.file:
+            return
+        if self.omitted:
+            self.write(
+                f"<h2>Report size limit reached: {self.omitted} more items not shown</h2>\n"
+            )
+        self.close_page()
+
+    def define_glyph(self, gid, new_glyphs):
+        if gid not in self.defined:
+            if gid not in self.glyph_paths:
+                self.glyph_paths[gid] = self.vharfbuzz.glyph_to_svg_path(gid)
+            new_glyphs.append(f'<path id="glyph{gid}" d="{self.glyph_paths[gid]}"/>')
+            self.defined.add(gid)
+
+    def layers(self, gid):
+        """A colour glyph's (layer glyph, fill) pairs, or None if it has none."""
+        if gid not in self.glyph_layers:
+            face = self.vharfbuzz.hbfont.face
+            layers = None
+            if hasattr(hb, "ot_color_has_layers") and hb.ot_color_has_layers(face):
+                layers = hb.ot_color_glyph_get_layers(face, gid)
+            if layers:
+                layers = [
+                    (
+                        layer.glyph,
+                        self.vharfbuzz._to_svg_color(self.vharfbuzz.palette[layer.color_index])
+                        if layer.color_index != 0xFFFF
+                        else None,
+                    )
+                    for layer in layers
+                ]
+            self.glyph_layers[gid] = layers or None
+        return self.glyph_layers[gid]
+
+    def buf_to_svg(self, buf):
+        # Like Vharfbuzz.buf_to_svg, but glyphs (and colour glyphs' layers)
+        # are defined once per page.
+        hbfont = self.vharfbuzz.hbfont
+        font_extents = hbfont.get_font_extents("ltr")
+        y_max = font_extents.ascender
+        y_min = font_extents.descender
+        x_min = x_max = 0
+
+        new_glyphs = []
+        uses = []
+        x_cursor = 0
+        y_cursor = 0
+        for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+            gid = info.codepoint
+            cur_x = x_cursor + pos.x_offset
+            cur_y = y_cursor + pos.y_offset
+            layers = self.layers(gid)
+            if layers:
+                for layer, fill in layers:
+                    self.define_glyph(layer, new_glyphs)
+                    fill = f' fill="{fill}"' if fill else ""
+                    uses.append(f'<use href="#glyph{layer}" x="{cur_x}" y="{cur_y}"{fill}/>')
+            else:
+                self.define_glyph(gid, new_glyphs)
+                uses.append(f'<use href="#glyph{gid}" x="{cur_x}" y="{cur_y}"/>')
+
+            if extents := hbfont.get_glyph_extents(gid):
+                x_min = min(x_min, cur_x + min(extents.x_bearing, 0))
+                y_min = min(
+                    y_min, cur_y + min(extents.height + extents.y_bearing, pos.y_advance)
+                )
+                x_max = max(
+                    x_max, cur_x + max(extents.width + extents.x_bearing, pos.x_advance)
+                )
+                y_max = max(y_max, cur_y + max(extents.y_bearing, 0))
+
+            x_cursor += pos.x_advance
+            y_cursor += pos.y_advance
+
+        if new_glyphs:
+            self.write(
+                '<svg style="position:absolute;width:0;height:0"><defs>\n'
+                + "\n".join(new_glyphs)
+                + "\n</defs></svg>\n"
+            )
+        return "\n".join(
+            [
+                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x_min} {y_min} {x_max - x_min} {y_max - y_min}" transform="matrix(1 0 0 -1 0 0)">',
+                *uses,
+                "</svg>",
+                "",
+            ]
+        )
 
-def ensure_html_report_started(vharfbuzz):
-    global html_file
-    if html_file:
-        return
-    html_file = open(shaping_basedir / "report.html", "w")
-    filename = Path(vharfbuzz.filename)
-    html_file.write(HTML_HEADER % relpath(filename, shaping_basedir))
+    def add(self, message, text=None, buf1=None, buf2=None, type="item", extra_data=None):
+        if not self.file:
+            return
+        if self.size >= self.max_size:
+            if type == "item":
+                self.omitted += 1
+            return
+        if type == "item":
+            if self.items >= self.items_per_page:
+                self.close_page(next_page=True)
+                self.open_page()
+            self.items += 1
+
+        vharfbuzz = self.vharfbuzz
+        if text:
+            message = message + ': <span class="tf">%s</span>' % text
+
+        if type == "item":
+            message = "<li>%s</li>" % message
+        if type == "header":
+            message = "<h2>%s</h2>" % message
+        self.write(message + "\n")
+        if extra_data:
+            self.write("<pre>%s</pre>" % extra_data)
+        if buf1:
+            self.write("<pre>Got     : %s</pre>" % vharfbuzz.serialize_buf(buf1))
+        if buf2:
+            self.write("<pre>Expected: %s</pre>" % vharfbuzz.serialize_buf(buf2))
+        if buf1:
+            svg = self.buf_to_svg(buf1)
+            self.write("Got:")
+            self.write(svg)
+        if buf2:
+            svg = self.buf_to_svg(buf2)
+            self.write("Expected:")
+            self.write(svg)
+
+
+html_report = None
 
 
 def report_to_html(vharfbuzz, message, text=None, buf1=None, buf2=None, type="item", extra_data=None):
-    ensure_html_report_started(vharfbuzz)
-    global html_file
-    if text:
-        message = message + ': <span class="tf">%s</span>' % text
-
-    if type == "item":
-        message = "<li>%s</li>" % message
-    if type == "header":
-        message = "<h2>%s</h2>" % message
-    html_file.write(message + "\n")
-    if extra_data:
-        html_file.write("<pre>%s</pre>" % extra_data)
-    if buf1:
-        html_file.write("<pre>Got     : %s</pre>" % vharfbuzz.serialize_buf(buf1))
-    if buf2:
-        html_file.write("<pre>Expected: %s</pre>" % vharfbuzz.serialize_buf(buf2))
-    if buf1:
-        html_file.write("Got:")
-        html_file.write(vharfbuzz.buf_to_svg(buf1))
-    if buf2:
-        html_file.write("Expected:")
-        html_file.write(vharfbuzz.buf_to_svg(buf2))
+    global html_report
+    if not html_report:
+        html_report = HTMLReport(vharfbuzz)
+    html_report.add(message, text, buf1, buf2, type, extra_data)
 
 
 def get_from_test_with_default(test, configuration, el, default=None):
@@ -105,35 +329,178 @@ def get_shaping_parameters(test, configuration):
     return params
 
 
+def is_pattern_test(test, configuration):
+    return (
+        get_from_test_with_default(test, configuration, "input_type", "string")
+        == "pattern"
+    )
+
+
+class PatternExpansion:
+    """The strings matched by a StringBrewer pattern, generated lazily.
+
+    If there are more than ``max_strings`` of them, a reproducible sample of
+    ``max_strings`` is taken instead: the expansion is cut into that many
+    equal strata and one string is drawn from each using a seeded generator.
+    The expansion is enumerated ingredient by ingredient, so this spreads the
+    sample across all the alternatives rather than bunching it at the start.
+    """
+
+    def __init__(self, recipe, ingredients, max_strings, seed=0):
+        self.recipe = recipe
+        sb = StringBrewer(recipe=recipe, ingredients=ingredients)
+        self.strings = AllStrings(sb.regex)
+        # Not len(), which overflows on really big patterns
+        self.total = self.strings.__len__()
+        self.max_strings = max_strings
+        self.seed = seed
+
+    @property
+    def sampled(self):
+        return self.total > self.max_strings
+
+    @property
+    def tested(self):
+        return min(self.total, self.max_strings)
+
+    def __iter__(self):
+        if not self.sampled:
+            yield from self.strings
+            return
+        rng = random.Random(self.seed)
+        for i in range(self.max_strings):
+            start = i * self.total // self.max_strings
+            end = (i + 1) * self.total // self.max_strings
+            yield self.strings[rng.randrange(start, end)]
+
+
+def shaping_key(text, parameters):
+    return (text, json.dumps(parameters, sort_keys=True))
+
+
+class ShapingSession:
+    """Shaping state shared between all the checks for one font.
+
+    The test corpus is read and validated once, patterns are expanded once,
+    and each distinct literal input is shaped once, however many checks ask
+    for it. Strings expanded from patterns aren't kept, as there can be
+    hundreds of thousands of them; they come from the persistent shaping
+    cache instead, if there is one.
+    """
+
+    def __init__(self, ttFont):
+        self.ttFont = ttFont
+        self.filename = Path(ttFont.reader.file.name)
+        self.vharfbuzz = Vharfbuzz(self.filename)
+        self.shaper = CachedShaper(self.vharfbuzz, get_shaping_cache())
+        self.incremental = None
+        if shaping_incremental and self.shaper.cache:
+            self.incremental = LookupIndex(
+                shaping_basedir / ".lookup-index", self.shaper
+            )
+        self.corpus = list(self.load_corpus())
+        self._results = {}
+        self._expansions = {}
+        self._preparations = {}
+        self._pool = None
+
+    @property
+    def pool(self):
+        """A ShapingPool for this font, or None if running serially."""
+        if self._pool is None and shaping_jobs > 1 and not self.incremental:
+            self._pool = ShapingPool(self.filename, shaping_jobs)
+            # The session lasts as long as the fontbakery run
+            atexit.register(self._pool.close)
+        return self._pool
+
+    def load_corpus(self):
+        # Yields (shaping_file, configuration, tests, error) for each file
+        # in the order the old per-check runner used to visit them.
+        for shaping_file in shaping_basedir.glob("*.json"):
+            try:
+                shaping_input_doc = json.loads(shaping_file.read_text())
+            except Exception as e:
+                yield shaping_file, None, None, f"{shaping_file}: Invalid JSON: {e}."
+                continue
+
+            configuration = shaping_input_doc.get("configuration", {})
+            try:
+                shaping_tests = shaping_input_doc["tests"]
+            except KeyError:
+                yield shaping_file, None, None, (
+                    f"{shaping_file}: Must have an 'tests' key dict."
+                )
+                continue
+            yield shaping_file, configuration, shaping_tests, None
+
+    def shape(self, text, parameters, memoize=True):
+        key = shaping_key(text, parameters)
+        if key in self._results:
+            return self._results[key]
+        if self.incremental:
+            buf = self.incremental.shape(text, parameters)
+        else:
+            buf = self.shaper.shape(text, parameters)
+        if memoize:
+            self._results[key] = buf
+        return buf
+
+    def strings_for(self, test, configuration):
+        if not is_pattern_test(test, configuration):
+            return [test["input"]]
+        ingredients = configuration["ingredients"]
+        max_strings = get_from_test_with_default(
+            test, configuration, "max_strings", DEFAULT_MAX_STRINGS
+        )
+        seed = get_from_test_with_default(test, configuration, "seed", 0)
+        key = (
+            test["input"],
+            json.dumps(ingredients, sort_keys=True),
+            max_strings,
+            seed,
+        )
+        if key not in self._expansions:
+            self._expansions[key] = PatternExpansion(
+                test["input"], ingredients, max_strings, seed
+            )
+        return self._expansions[key]
+
+    def prepare(self, preparation, shaping_file, configuration):
+        key = (preparation, shaping_file)
+        if key not in self._preparations:
+            self._preparations[key] = preparation(self.ttFont, configuration)
+        return self._preparations[key]
+
+
+@condition
+def shaping_session(ttFont):
+    return ShapingSession(ttFont)
+
+
 # This is a very generic "do something with shaping" test runner.
 # It'll be given concrete meaning later.
 def run_a_set_of_tests(
-    ttFont, run_a_test, test_filter, generate_report, preparation=None
+    session, run_a_test, test_filter, generate_report, preparation=None
 ):
-    filename = Path(ttFont.reader.file.name)
-    vharfbuzz = Vharfbuzz(filename)
+    filename = session.filename
+    vharfbuzz = session.vharfbuzz
     shaping_file_found = False
     ran_a_test = False
     extra_data = None
-    for shaping_file in shaping_basedir.glob("*.json"):
+    if session.incremental:
+        reused = session.incremental.reused
+        reshaped = session.incremental.reshaped
+    for shaping_file, configuration, shaping_tests, error in session.corpus:
         shaping_file_found = True
-        try:
-            shaping_input_doc = json.loads(shaping_file.read_text())
-        except Exception as e:
-            yield FAIL, (f"{shaping_file}: Invalid JSON: {e}.")
-            return
-
-        configuration = shaping_input_doc.get("configuration", {})
-        try:
-            shaping_tests = shaping_input_doc["tests"]
-        except KeyError:
-            yield FAIL, (f"{shaping_file}: Must have an 'tests' key dict.")
+        if error:
+            yield FAIL, error
             return
 
         if preparation:
-            extra_data = preparation(ttFont, configuration)
+            extra_data = session.prepare(preparation, shaping_file, configuration)
 
         failed_tests = []
+        expansions = []
         for test in shaping_tests:
             if not test_filter(test, configuration):
                 continue
@@ -152,15 +519,33 @@ def run_a_set_of_tests(
                 continue
 
             run_a_test(
-                filename, vharfbuzz, test, configuration, failed_tests, extra_data
+                filename, session, test, configuration, failed_tests, extra_data
             )
             ran_a_test = True
+            if is_pattern_test(test, configuration):
+                expansions.append(session.strings_for(test, configuration))
 
         if ran_a_test:
             if not failed_tests:
                 yield PASS, f"{shaping_file}: No regression detected"
             else:
                 yield from generate_report(vharfbuzz, shaping_file, failed_tests)
+                if html_report:
+                    html_report.flush()
+            for expansion in expansions:
+                sampled = " (sampled)" if expansion.sampled else ""
+                yield INFO, (
+                    f"{shaping_file}: Tested {expansion.tested} of {expansion.total}"
+                    f" strings{sampled} from pattern '{expansion.recipe}'"
+                )
+
+    if session.incremental:
+        session.incremental.save()
+        yield INFO, (
+            f"Incremental run: shaped"
+            f" {session.incremental.reshaped - reshaped} strings, reused"
+            f" {session.incremental.reused - reused} earlier results"
+        )
 
     if not shaping_file_found:
         yield SKIP, "No test files found."
@@ -172,10 +557,10 @@ def run_a_set_of_tests(
 
 
 @check(id="com.google.fonts/check/shaping/regression")
-def com_google_fonts_check_shaping_regression(ttFont):
+def com_google_fonts_check_shaping_regression(ttFont, shaping_session):
     """Check that texts shape as per expectation"""
     yield from run_a_set_of_tests(
-        ttFont,
+        shaping_session,
         run_shaping_regression,
         lambda test, configuration: "expectation" in test,
         gereate_shaping_regression_report,
@@ -183,11 +568,12 @@ def com_google_fonts_check_shaping_regression(ttFont):
 
 
 def run_shaping_regression(
-    filename, vharfbuzz, test, configuration, failed_tests, extra_data
+    filename, session, test, configuration, failed_tests, extra_data
 ):
+    vharfbuzz = session.vharfbuzz
     shaping_text = test["input"]
     parameters = get_shaping_parameters(test, configuration)
-    output_buf = vharfbuzz.shape(shaping_text, parameters)
+    output_buf = session.shape(shaping_text, parameters)
     expectation = test["expectation"]
     if isinstance(expectation, dict):
         expectation = expectation.get(filename.name, expectation["default"])
@@ -201,6 +587,7 @@ def run_shaping_regression(
 
 def gereate_shaping_regression_report(vharfbuzz, shaping_file, failed_tests):
     report_items = []
+    clusters = FailureClusters()
     header = f"{shaping_file}: Expected and actual shaping not matching"
     report_to_html(vharfbuzz, header, type="header")
     for test, expected, output_buf, output_serialized in failed_tests:
@@ -224,7 +611,11 @@ def gereate_shaping_regression_report(vharfbuzz, shaping_file, failed_tests):
             f"   expected: {expected}\n"
             f"   got: {output_serialized}"
         )
+        clusters.add(test["input"], expected, output_serialized)
 
+    if len(failed_tests) > CLUSTER_FAILURES_OVER:
+        report_items = [f" {len(failed_tests)} failures in {len(clusters)} groups."]
+        report_items.extend(clusters.report("expected", "got"))
     yield FAIL, (header + "\n" + "\n".join(report_items))
 
 
@@ -232,10 +623,10 @@ def gereate_shaping_regression_report(vharfbuzz, shaping_file, failed_tests):
 
 
 @check(id="com.google.fonts/check/shaping/forbidden")
-def com_google_fonts_check_shaping_forbidden(ttFont):
+def com_google_fonts_check_shaping_forbidden(ttFont, shaping_session):
     """Check that no forbidden glyphs are found while shaping"""
     yield from run_a_set_of_tests(
-        ttFont,
+        shaping_session,
         run_forbidden_glyph_test,
         lambda test, configuration: "forbidden_glyphs" in configuration,
         forbidden_glyph_test_results,
@@ -243,24 +634,26 @@ def com_google_fonts_check_shaping_forbidden(ttFont):
 
 
 def run_forbidden_glyph_test(
-    filename, vharfbuzz, test, configuration, failed_tests, extra_data
+    filename, session, test, configuration, failed_tests, extra_data
 ):
-    is_stringbrewer = (
-        get_from_test_with_default(test, configuration, "input_type", "string")
-        == "pattern"
-    )
+    vharfbuzz = session.vharfbuzz
     parameters = get_shaping_parameters(test, configuration)
     forbidden_glyphs = configuration["forbidden_glyphs"]
-    if is_stringbrewer:
-        sb = StringBrewer(
-            recipe=test["input"], ingredients=configuration["ingredients"]
-        )
-        strings = sb.generate_all()
-    else:
-        strings = [test["input"]]
+    strings = session.strings_for(test, configuration)
 
+    if session.pool and is_pattern_test(test, configuration):
+        results = session.pool.forbidden(strings, parameters, forbidden_glyphs)
+        for shaping_text, found in results:
+            if not found:
+                continue
+            output_buf = session.shape(shaping_text, parameters, memoize=False)
+            for forbidden in found:
+                failed_tests.append((shaping_text, output_buf, forbidden))
+        return
+
+    memoize = not is_pattern_test(test, configuration)
     for shaping_text in strings:
-        output_buf = vharfbuzz.shape(shaping_text, parameters)
+        output_buf = session.shape(shaping_text, parameters, memoize)
         output_serialized = vharfbuzz.serialize_buf(output_buf, glyphsonly=True)
         glyph_names = output_serialized.split("|")
         for forbidden in forbidden_glyphs:
@@ -287,10 +680,10 @@ def forbidden_glyph_test_results(vharfbuzz, shaping_file, failed_tests):
 
 
 @check(id="com.google.fonts/check/shaping/collides")
-def com_google_fonts_check_shaping_collides(ttFont):
+def com_google_fonts_check_shaping_collides(ttFont, shaping_session):
     """Check that no collisions are found while shaping"""
     yield from run_a_set_of_tests(
-        ttFont,
+        shaping_session,
         run_collides_glyph_test,
         lambda test, configuration: "collidoscope" in test
         or "collidoscope" in configuration,
@@ -313,27 +706,32 @@ def setup_glyph_collides(ttFont, configuration):
 
 
 def run_collides_glyph_test(
-    filename, vharfbuzz, test, configuration, failed_tests, extra_data
+    filename, session, test, configuration, failed_tests, extra_data
 ):
     col = extra_data["collidoscope"]
-    is_stringbrewer = (
-        get_from_test_with_default(test, configuration, "input_type", "string")
-        == "pattern"
-    )
     parameters = get_shaping_parameters(test, configuration)
     allowed_collisions = get_from_test_with_default(
         test, configuration, "allowedcollisions", []
     )
-    if is_stringbrewer:
-        sb = StringBrewer(
-            recipe=test["input"], ingredients=configuration["ingredients"]
+    strings = session.strings_for(test, configuration)
+
+    if session.pool and is_pattern_test(test, configuration):
+        results = session.pool.collisions(
+            strings,
+            parameters,
+            configuration["collidoscope"],
+            configuration.get("direction", "LTR"),
+            allowed_collisions,
         )
-        strings = sb.generate_all()
-    else:
-        strings = [test["input"]]
+        for shaping_text, bumps, draw in results:
+            if bumps:
+                output_buf = session.shape(shaping_text, parameters, memoize=False)
+                failed_tests.append((shaping_text, bumps, draw, output_buf))
+        return
 
+    memoize = not is_pattern_test(test, configuration)
     for shaping_text in strings:
-        output_buf = vharfbuzz.shape(shaping_text, parameters)
+        output_buf = session.shape(shaping_text, parameters, memoize)
         glyphs = col.get_glyphs(shaping_text, buf=output_buf)
         collisions = col.has_collisions(glyphs)
         bumps = [f"{c.glyph1}/{c.glyph2}" for c in collisions]
@@ -0,0 +1,273 @@
+"""Metrics for every glyph in a font at once, as NumPy arrays.
+
+Rather than asking for each glyph's metrics in turn, the bounds are read
+straight out of the ``glyf`` table's glyph headers and the advances out of
+``hmtx``, one column per metric, indexed by glyph ID. Fonts without stored
+bounds (CFF), and variable fonts at a location other than the default, are
+measured with HarfBuzz instead.
+
+    metrics = GlyphMetrics.from_file("MyFont.ttf")
+    metrics.ranked(metrics["yMax"], 3)  # the three tallest glyphs
+    bold = GlyphMetrics.from_file("MyFont-VF.ttf", {"wght": 900})
+
+Measuring a font means parsing it, so ``indexed_metrics`` keeps the
+measurements of each font binary (and location) in an index file, one
+record per glyph, which later calls memory-map instead:
+
+    metrics = indexed_metrics("MyFont.ttf")
+
+Once the index files grow beyond a size limit, the least recently used are
+thrown away.
+"""
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+import uharfbuzz as hb
+from fontTools.ttLib import TTFont
+
+FIELDS = ("xMin", "xMax", "yMin", "yMax", "width", "lsb", "rise", "category")
+# Changed whenever the index files' contents change
+INDEX_VERSION = 1
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# GDEF glyph classes, with 0 for glyphs which haven't got one
+CATEGORIES = ["unknown", "base", "ligature", "mark", "component"]
+
+
+def horizontal_metrics(font):
+    """Advance widths and left side bearings from the raw ``hmtx`` table."""
+    count = font["maxp"].numGlyphs
+    metrics = font["hhea"].numberOfHMetrics
+    data = np.frombuffer(font.reader["hmtx"], dtype=">u2", count=2 * metrics)
+    widths = np.empty(count, dtype=np.int32)
+    widths[:metrics] = data[0::2]
+    # Glyphs after the last long metric share its advance, and just have
+    # their side bearings listed
+    widths[metrics:] = data[2 * metrics - 2]
+    lsbs = np.empty(count, dtype=np.int32)
+    lsbs[:metrics] = data[1::2].view(">i2")
+    lsbs[metrics:] = np.frombuffer(
+        font.reader["hmtx"], dtype=">i2", count=count - metrics, offset=4 * metrics
+    )
+    return widths, lsbs
+
+
+def glyf_bounds(font):
+    """(xMin, yMin, xMax, yMax) columns from the raw ``glyf`` glyph headers."""
+    count = font["maxp"].numGlyphs
+    if font["head"].indexToLocFormat:
+        loca = np.frombuffer(font.reader["loca"], dtype=">u4", count=count + 1)
+    else:
+        loca = np.frombuffer(font.reader["loca"], dtype=">u2", count=count + 1).astype(np.uint32) * 2
+    glyf = np.frombuffer(font.reader["glyf"], dtype=np.uint8)
+    starts = loca[:-1].astype(np.int64)
+    present = loca[1:] > loca[:-1]
+    bounds = np.zeros((count, 4), dtype=np.int32)
+    # numberOfContours, then the bounds, as big-endian int16s
+    headers = glyf[starts[present, None] + np.arange(2, 10)]
+    bounds[present] = headers.view(">i2").reshape(-1, 4)
+    return bounds.T
+
+
+def harfbuzz_metrics(filename, location=None):
+    """(xMin, yMin, xMax, yMax, width) columns measured by HarfBuzz."""
+    with open(filename, "rb") as fontfile:
+        face = hb.Face(fontfile.read())
+    hbfont = hb.Font(face)
+    if location:
+        hbfont.set_variations(location)
+    columns = np.zeros((5, face.glyph_count), dtype=np.int32)
+    for gid in range(face.glyph_count):
+        extents = hbfont.get_glyph_extents(gid)
+        if extents:
+            columns[0, gid] = extents.x_bearing
+            columns[1, gid] = extents.y_bearing + extents.height
+            columns[2, gid] = extents.x_bearing + extents.width
+            columns[3, gid] = extents.y_bearing
+        columns[4, gid] = hbfont.get_glyph_h_advance(gid)
+    return columns
+
+
+def categories(font):
+    """GDEF glyph classes, 0 where there is none."""
+    classes = np.zeros(font["maxp"].numGlyphs, dtype=np.int32)
+    if "GDEF" in font and font["GDEF"].table.GlyphClassDef:
+        for glyphname, glyphclass in font["GDEF"].table.GlyphClassDef.classDefs.items():
+            classes[font.getGlyphID(glyphname)] = glyphclass
+    return classes
+
+
+def rises(font):
+    """The difference in height between each glyph's cursive entry and exit.
+
+    Glyphs with an entry but no exit rise by the entry's height; glyphs
+    with only an exit don't rise. Where several lookups give a glyph
+    anchors, the last one wins."""
+    count = font["maxp"].numGlyphs
+    entries = {}
+    exits = {}
+    if "GPOS" in font and font["GPOS"].table.LookupList:
+        for lookup in font["GPOS"].table.LookupList.Lookup:
+            if lookup.LookupType != 3:
+                continue
+            for subtable in lookup.SubTable:
+                for glyphname, record in zip(subtable.Coverage.glyphs, subtable.EntryExitRecord):
+                    if record.EntryAnchor:
+                        entries[glyphname] = record.EntryAnchor.YCoordinate
+                    if record.ExitAnchor:
+                        exits[glyphname] = record.ExitAnchor.YCoordinate
+    rise = np.zeros(count, dtype=np.int32)
+    for glyphname, entry in entries.items():
+        rise[font.getGlyphID(glyphname)] = entry - exits.get(glyphname, 0)
+    return rise
+
+
+class GlyphMetrics:
+    """Columns of glyph metrics, indexed by glyph ID.
+
+    Args:
+        names: The glyph names, in glyph order.
+        columns: A dictionary of arrays, one for each of ``FIELDS``.
+    """
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_file(cls, filename, location=None):
+        """Measures a font's glyphs, at a location in its design space if given."""
+        font = TTFont(filename, lazy=True)
+        if location:
+            xmin, ymin, xmax, ymax, width = harfbuzz_metrics(filename, location)
+            lsb = xmin
+        else:
+            width, lsb = horizontal_metrics(font)
+            if "glyf" in font:
+                xmin, ymin, xmax, ymax = glyf_bounds(font)
+            else:
+                xmin, ymin, xmax, ymax, _ = harfbuzz_metrics(filename)
+        columns = {
+            "xMin": xmin,
+            "xMax": xmax,
+            "yMin": ymin,
+            "yMax": ymax,
+            "width": width,
+            "lsb": lsb,
+            "rise": rises(font),
+            "category": categories(font),
+        }
+        return cls(font.getGlyphOrder(), columns)
+
+    def ranked(self, values, count, largest=True, subset=None):
+        """Returns (glyph name, value) for the ``count`` glyphs with the
+        largest (or smallest) values, in increasing order of value.
+
+        ``subset`` is an array of the glyph IDs to choose from. Ties go the
+        way a stable sort by value would: to the earlier glyph when looking
+        for the smallest values, and the later one for the largest."""
+        if subset is None:
+            subset = np.arange(len(self.names))
+        count = min(count, len(subset))
+        if not count:
+            return []
+        # Folding the glyph ID into the key breaks ties without a full sort
+        keys = values[subset].astype(np.int64) * len(self.names) + subset
+        if largest:
+            chosen = np.argpartition(keys, len(keys) - count)[len(keys) - count:]
+        else:
+            chosen = np.argpartition(keys, count - 1)[:count]
+        chosen = chosen[np.argsort(keys[chosen])]
+        return [(self.names[subset[ix]], int(values[subset[ix]])) for ix in chosen]
+
+
+def default_index_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base, "font-engineering", "glyph-metrics")
+
+
+def index_key(filename, location=None):
+    """Identifies a font binary (and a location in it)."""
+    digest = hashlib.sha256(f"{INDEX_VERSION}".encode())
+    with open(filename, "rb") as fontfile:
+        digest.update(fontfile.read())
+    for axis, value in sorted((location or {}).items()):
+        digest.update(f"{axis}={float(value)}".encode())
+    return digest.hexdigest()
+
+
+def evict(index_dir, max_size=DEFAULT_MAX_SIZE, keep=None):
+    """Removes the least recently used index files (other than ``keep``'s)
+    until the rest take up no more than ``max_size`` bytes.
+
+    An index was last used when its records file was last modified."""
+    indexes = []
+    for records_path in Path(index_dir).glob("*.npy"):
+        names_path = records_path.with_suffix(".names")
+        try:
+            used = records_path.stat().st_mtime
+            size = records_path.stat().st_size + names_path.stat().st_size
+        except FileNotFoundError:
+            # Half written, or being removed by another process
+            continue
+        indexes.append((used, size, records_path, names_path))
+    excess = sum(size for _, size, _, _ in indexes) - max_size
+    if excess <= 0:
+        return
+    # Trim a little further than needed so we don't evict on every write
+    excess += max_size // 10
+    for _, size, records_path, names_path in sorted(indexes):
+        if excess <= 0:
+            break
+        if records_path == keep:
+            continue
+        for path in (records_path, names_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        excess -= size
+
+
+def indexed_metrics(filename, location=None, index_dir=None, max_size=DEFAULT_MAX_SIZE):
+    """Returns a font's ``GlyphMetrics``, from its index file if it has one.
+
+    Otherwise the font is measured and the index file written, as an array
+    of records (one per glyph ID) and a file of glyph names, and older index
+    files evicted to keep them all within ``max_size`` bytes. The columns
+    returned from an index file are views of a memory map of it."""
+    index_dir = Path(index_dir or default_index_dir())
+    key = index_key(filename, location)
+    records_path = index_dir / f"{key}.npy"
+    names_path = index_dir / f"{key}.names"
+    if records_path.exists() and names_path.exists():
+        try:
+            # Mark it as recently used
+            os.utime(records_path)
+        except OSError:
+            pass
+        records = np.load(records_path, mmap_mode="r")
+        names = names_path.read_text(encoding="utf-8").split("\n")
+        return GlyphMetrics(names, {field: records[field] for field in FIELDS})
+
+    metrics = GlyphMetrics.from_file(filename, location)
+    records = np.empty(len(metrics), dtype=[(field, np.int32) for field in FIELDS])
+    for field in FIELDS:
+        records[field] = metrics[field]
+    index_dir.mkdir(parents=True, exist_ok=True)
+    # Written under temporary names first, so that tools running at the
+    # same time never see half an index
+    suffix = f".{os.getpid()}.tmp"
+    with open(str(records_path) + suffix, "wb") as fh:
+        np.save(fh, records)
+    Path(str(names_path) + suffix).write_text("\n".join(metrics.names), encoding="utf-8")
+    os.replace(str(names_path) + suffix, names_path)
+    os.replace(str(records_path) + suffix, records_path)
+    evict(index_dir, max_size, keep=records_path)
+    return metrics
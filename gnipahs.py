@@ -1,134 +1,347 @@
 #!/usr/bin/env python3
 from collidoscope import Collidoscope
 from vharfbuzz import Vharfbuzz
-from fontTools.ttLib import TTFont
 import sys
 from argparse import ArgumentParser
-import warnings
+from itertools import islice
+from multiprocessing import Pool
+import hashlib
+import json
+import random
 import re
+import threading
+import time
 from termcolor import colored
 from stringbrewer import StringBrewer
+from sre_yield import AllStrings
+from shapecache import CachedShaper, ShapingCache, font_hash
+from seenstrings import SeenStrings
 import os
 
+CHUNK_SIZE = 100
+# Sampling gives up once this many draws in a row turn up nothing new
+MAX_MISSES = 1000
+# Strings drawn for each one kept when sampling for coverage
+CANDIDATES = 8
 
-parser = ArgumentParser(description="Shaping regression tests")
-parser.add_argument("--show-all", help="Adding passing tests to output file", action="store_true")
-parser.add_argument("font", help="Font file", metavar="FONT")
-parser.add_argument("testfile", help="File containing tests", metavar="TESTFILE")
-args = parser.parse_args()
-
-vhb = Vharfbuzz(args.font)
-col = Collidoscope(
-    args.font,
-    {
-        #"cursive": True,
-        "marks": True,
-        "faraway": True,
-        "adjacentmarks": False,
-        # "area": 0,
-    },
-)
-
-tests = []
-ingredients = []
-seen_blank = False
-failed = []
-general_options = {}
-
-with open(args.testfile, "r") as testfile:
-    for line in testfile.read().split("\n"):
-        if re.match(r"^\s*#", line):
-            continue
-        if line == "":
-            seen_blank = True
-        if seen_blank:
-            ingredients.append(line)
-        elif line.startswith("["):
-            m = re.match(r"^\[(\w+)=([^]]+)\]$",line)
-            general_options[m[1]] = m[2]
+COLLISION_RULES = {
+    #"cursive": True,
+    "marks": True,
+    "faraway": True,
+    "adjacentmarks": False,
+    # "area": 0,
+}
+
+
+def parse_testfile(filename):
+    tests = []
+    ingredients = []
+    seen_blank = False
+    general_options = {}
+
+    with open(filename, "r") as testfile:
+        for line in testfile.read().split("\n"):
+            if re.match(r"^\s*#", line):
+                continue
+            if line == "":
+                seen_blank = True
+            if seen_blank:
+                ingredients.append(line)
+            elif line.startswith("["):
+                m = re.match(r"^\[(\w+)=([^]]+)\]$",line)
+                general_options[m[1]] = m[2]
+            else:
+                elements = line.split(":")
+                if elements[0].startswith('"') and elements[0].endswith('"'):
+                    tests.append(
+                        {
+                            "type": "literal",
+                            "string": elements[0][1:-1],
+                            "options": elements[1:],
+                        }
+                    )
+                else:
+                    tests.append(
+                        {"type": "pattern", "string": elements[0], "options": elements[1:]}
+                    )
+    return tests, ingredients, general_options
+
+
+def pairs(string):
+    return {string[i : i + 2] for i in range(len(string) - 1)}
+
+
+def sample_strings(regex, rng, samples, deadline=None, coverage=False):
+    """Yields distinct random strings matching a regular expression.
+
+    Stops after ``samples`` strings, at the ``deadline`` (a
+    ``time.monotonic()`` value) or when no new strings can be found. In
+    coverage mode, several strings are drawn each time and the one with
+    the most adjacent character pairs not yet tested is kept.
+    """
+    strings = AllStrings(regex)
+    total = strings.__len__()
+    seen = SeenStrings()
+    covered = set()
+    produced = 0
+    misses = 0
+    while produced < samples and misses < MAX_MISSES:
+        if deadline and time.monotonic() > deadline:
+            return
+        if coverage:
+            candidates = [
+                strings[rng.randrange(total)] for i in range(CANDIDATES)
+            ]
+            candidates = [c for c in candidates if c not in seen]
+            if not candidates:
+                misses += 1
+                continue
+            string = max(candidates, key=lambda c: len(pairs(c) - covered))
+            covered |= pairs(string)
+            seen.add(string)
         else:
-            elements = line.split(":")
-            if elements[0].startswith('"') and elements[0].endswith('"'):
-                tests.append(
-                    {
-                        "type": "literal",
-                        "string": elements[0][1:-1],
-                        "options": elements[1:],
-                    }
-                )
+            string = strings[rng.randrange(total)]
+            if not seen.add(string):
+                misses += 1
+                continue
+        misses = 0
+        produced += 1
+        yield string
+
+
+def test_strings(test, ingredients, samples=1000, seed=0, time_budget=None, coverage=False):
+    if test["type"] == "literal":
+        yield test["string"]
+        return
+    b = StringBrewer(from_string=test["string"] + "\n" + "\n".join(ingredients))
+    try:
+        strings = b.generate_all()
+    except Exception as e:
+        # Too many to test them all. Seeding by the pattern as well keeps
+        # each test's sample the same when others are added or removed.
+        rng = random.Random(f"{seed}:{test['string']}")
+        deadline = None
+        if time_budget:
+            deadline = time.monotonic() + time_budget
+        strings = sample_strings(b.regex, rng, samples, deadline, coverage)
+        print(f"Sampling pattern '{test['string']}' ({e})", file=sys.stderr)
+    yield from strings
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Each worker process (or the main process, when running serially) sets up
+# its own shaper and collision detector.
+worker = None
+
+
+class Tester:
+    def __init__(self, font, general_options, use_cache):
+        self.vhb = Vharfbuzz(font)
+        self.shaper = CachedShaper(self.vhb, ShapingCache() if use_cache else None)
+        self.col = Collidoscope(font, COLLISION_RULES)
+        self.forbidden_gids = None
+        if "forbidden" in general_options:
+            forbidden = general_options["forbidden"].split(",")
+            self.forbidden_gids = {
+                gid for gid, name in enumerate(self.col.glyphorder) if name in forbidden
+            }
+
+    def do_test(self, string, options):
+        """Returns a (passed, message) pair for each test run on the string."""
+        results = []
+        # Shape once, and hand the same buffer to every test
+        buf = self.shaper.shape(string)
+        glyphs = self.col.get_glyphs(string, buf=buf)
+        collisions = self.col.has_collisions(glyphs)
+        if collisions:
+            results.append((False, "overlap test"))
+        else:
+            results.append((True, "overlap test"))
+        if self.forbidden_gids is not None:
+            if any(info.codepoint in self.forbidden_gids for info in buf.glyph_infos):
+                results.append((False, "forbidden glyph"))
+            else:
+                results.append((True, "forbidden glyphs"))
+        if len(options) > 0:
+            expected = options[0]
+            got = self.vhb.serialize_buf(buf)
+            if expected == got:
+                results.append((True, "shaping test"))
             else:
-                tests.append(
-                    {"type": "pattern", "string": elements[0], "options": elements[1:]}
+                results.append(
+                    (False, "shaping text: expected %s got %s" % (expected, got))
                 )
+        return results
+
+
+def init_worker(font, general_options, use_cache):
+    global worker
+    worker = Tester(font, general_options, use_cache)
 
-tested = 0
-passed = 0
-failreport = []
 
+def run_chunk(task):
+    test_index, chunk_index, strings, options = task
+    results = [(string, worker.do_test(string, options)) for string in strings]
+    # Worker processes don't run exit handlers, so don't leave this for close()
+    if worker.shaper.cache:
+        worker.shaper.cache.commit()
+    return test_index, chunk_index, results
+
+
+class Checkpoint:
+    """Results of each chunk of strings, appended to a file as they arrive.
+
+    The file starts with a line identifying the font, the test file and
+    the options deciding which strings are sampled from patterns; if any
+    of those have changed since it was written, it is started afresh.
+    """
+
+    def __init__(self, filename, font, testfile, sampling):
+        self.filename = filename
+        with open(testfile, "rb") as fh:
+            tests_hash = hashlib.sha256(fh.read()).hexdigest()
+        header = {"font": font_hash(font), "tests": tests_hash, "sampling": sampling}
+        self.done = {}
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                lines = fh.read().split("\n")
+            if lines and lines[0] and json.loads(lines[0]) == header:
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Probably cut off when the run was interrupted
+                        continue
+                    self.done[(entry["test"], entry["chunk"])] = entry["results"]
+                print(f"Resuming: {len(self.done)} chunks already done", file=sys.stderr)
+            else:
+                print(f"{filename} is for another font, test file or sampling; starting again", file=sys.stderr)
+        self.fh = open(filename, "a" if self.done else "w")
+        if not self.done:
+            self.fh.write(json.dumps(header) + "\n")
+            self.fh.flush()
 
-def tfail(test, string, message):
-    global tested
-    global failed
-    failed.append(string)
-    tested += 1
-    print(f"{colored('🗴 ', 'red')} '{string}' {message}")
+    def add(self, test_index, chunk_index, results):
+        self.fh.write(
+            json.dumps({"test": test_index, "chunk": chunk_index, "results": results})
+            + "\n"
+        )
+        self.fh.flush()
 
+    def finish(self):
+        self.fh.close()
+        os.remove(self.filename)
 
-def tpass(test, string, message):
-    global tested
-    global passed
-    global failed
-    if args.show_all:
-        failed.append(string)
-    tested += 1
-    passed += 1
-    # print(f"{colored('🗸 ', 'green')} '{string}' {message}")
 
+def main():
+    parser = ArgumentParser(description="Shaping regression tests")
+    parser.add_argument("--show-all", help="Adding passing tests to output file", action="store_true")
+    parser.add_argument("--no-cache", help="Don't use the persistent shaping cache", action="store_true")
+    parser.add_argument("--jobs", "-j", help="Number of worker processes (default: 1)", type=int, default=1)
+    parser.add_argument("--checkpoint", help="Record progress in this file, and resume from it if it exists", metavar="FILE")
+    parser.add_argument("--samples", help="Strings to test from patterns too big to test in full (default: 1000)", type=int, default=1000, metavar="N")
+    parser.add_argument("--time-budget", help="Stop sampling each pattern after this many seconds", type=float, metavar="SECONDS")
+    parser.add_argument("--seed", help="Random seed for sampling (default: 0)", type=int, default=0)
+    parser.add_argument("--coverage", help="Prefer samples containing character pairs not yet tested", action="store_true")
+    parser.add_argument("font", help="Font file", metavar="FONT")
+    parser.add_argument("testfile", help="File containing tests", metavar="TESTFILE")
+    args = parser.parse_args()
+    if args.checkpoint and args.time_budget:
+        # How many strings a time budget gets through differs from run to
+        # run, so the chunks of one run don't line up with the next one's
+        parser.error("--checkpoint can't be used with --time-budget")
 
-def do_test(string, options):
-    glyphs = col.get_glyphs(string)
-    collisions = col.has_collisions(glyphs)
-    if collisions:
-        tfail(test, string, "overlap test")
+    tests, ingredients, general_options = parse_testfile(args.testfile)
+    checkpoint = None
+    if args.checkpoint:
+        sampling = {"samples": args.samples, "seed": args.seed, "coverage": args.coverage}
+        checkpoint = Checkpoint(args.checkpoint, args.font, args.testfile, sampling)
+
+    # The pool would otherwise generate every task up front, so don't let
+    # string generation get more than a few chunks ahead of the testing.
+    # That way time budgets measure testing, not generation.
+    in_flight = threading.Semaphore(2 * max(args.jobs, 1))
+    stopping = False
+
+    def tasks():
+        for test_index, test in enumerate(tests):
+            strings = test_strings(
+                test,
+                ingredients,
+                samples=args.samples,
+                seed=args.seed,
+                time_budget=args.time_budget,
+                coverage=args.coverage,
+            )
+            for chunk_index, strings in enumerate(chunked(strings, CHUNK_SIZE)):
+                in_flight.acquire()
+                if stopping:
+                    return
+                if checkpoint and (test_index, chunk_index) in checkpoint.done:
+                    # Keep its place in the queue, but don't run it again
+                    strings = []
+                yield test_index, chunk_index, strings, test["options"]
+
+    initargs = (args.font, general_options, not args.no_cache)
+    pool = None
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_worker, initargs=initargs)
+        results = pool.imap(run_chunk, tasks())
     else:
-        tpass(test, string, "overlap test")
-    if "forbidden" in general_options:
-        forbidden = general_options["forbidden"].split(",")
-        glyphnames = [x["name"] for x in glyphs]
-        if any(x in forbidden for x in glyphnames):
-            tfail(test, string, "forbidden glyph")
-        else:
-            tpass(test, string, "forbidden glyphs")
-    if len(test["options"]) > 0:
-        buf = vhb.shape(string)
-        expected = options[0]
-        got = vhb.serialize_buf(buf)
-        if expected == got:
-            tpass(test, string, "shaping test")
-        else:
-            tfail(test, string, "shaping text: expected %s got %s" % (expected, got))
-
-
-for test in tests:
-    failed = []
-    failreport.append( (test["string"], failed ))
-    if test["type"] == "pattern":
-        b = StringBrewer(from_string=test["string"] + "\n" + "\n".join(ingredients))
-        try:
-            for s in b.generate_all():
-                do_test(s, test["options"])
-        except Exception as e:
-            for i in range(1, 1000):
-                do_test(b.generate(), test["options"])
-    if test["type"] == "literal":
-        do_test(test["string"], test["options"])
+        init_worker(*initargs)
+        results = map(run_chunk, tasks())
+
+    tested = 0
+    passed = 0
+    failreport = [(test["string"], []) for test in tests]
+    try:
+        for test_index, chunk_index, chunk_results in results:
+            in_flight.release()
+            if checkpoint:
+                if (test_index, chunk_index) in checkpoint.done:
+                    chunk_results = checkpoint.done[(test_index, chunk_index)]
+                else:
+                    checkpoint.add(test_index, chunk_index, chunk_results)
+            failed = failreport[test_index][1]
+            for string, string_results in chunk_results:
+                for ok, message in string_results:
+                    tested += 1
+                    if ok:
+                        passed += 1
+                        if args.show_all:
+                            failed.append(string)
+                        # print(f"{colored('🗸 ', 'green')} '{string}' {message}")
+                    else:
+                        failed.append(string)
+                        print(f"{colored('🗴 ', 'red')} '{string}' {message}")
+    except KeyboardInterrupt:
+        if pool:
+            # Let the task generator see that it should stop
+            stopping = True
+            in_flight.release(2 * args.jobs)
+            pool.terminate()
+        if checkpoint:
+            print(f"\nInterrupted; run again with --checkpoint {args.checkpoint} to resume")
+        sys.exit(1)
+    if pool:
+        pool.close()
+    if checkpoint:
+        checkpoint.finish()
 
-print("\n%i tests, %i passed, %i failing" % (tested, passed, tested - passed))
+    print("\n%i tests, %i passed, %i failing" % (tested, passed, tested - passed))
 
-slug = " \\qquad "
-# All your failing tests as a PDF
-with open("test-failures.sil", "w") as sil:
-    sil.write(f"""\\begin{{document}}
+    slug = " \\qquad "
+    # All your failing tests as a PDF
+    with open("test-failures.sil", "w") as sil:
+        sil.write(f"""\\begin{{document}}
 \\font[filename="{args.font}"]
 
 \\script[src=packages/linespacing]
@@ -136,9 +349,13 @@ with open("test-failures.sil", "w") as sil:
 \\set[parameter=linespacing.fixed.baselinedistance,value=3em]
 """)
 
-    for (string, failed) in failreport:
-        sil.write("\\bigskip \\font[family=Gentium Plus]{%s}\\bigskip" % string)
-        sil.write(slug.join(failed))
-    sil.write(r"\end{document}")
-os.system("sile test-failures.sil >/dev/null 2>/dev/null")
-os.system("open test-failures.pdf")
+        for (string, failed) in failreport:
+            sil.write("\\bigskip \\font[family=Gentium Plus]{%s}\\bigskip" % string)
+            sil.write(slug.join(failed))
+        sil.write(r"\end{document}")
+    os.system("sile test-failures.sil >/dev/null 2>/dev/null")
+    os.system("open test-failures.pdf")
+
+
+if __name__ == "__main__":
+    main()
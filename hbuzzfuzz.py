@@ -1,68 +1,256 @@
-from vharfbuzz import Vharfbuzz
 from stringbrewer import StringBrewer
+from rasterizer import GlyphRasterizer
+from shapingbackends import ShapingBackend, buffers_differ_batch
+from seenstrings import SeenStrings
+from multiprocessing import Pool
+from pathlib import Path
 import argparse
-import cairosvg
-import imageio
-import numpy as np
-
-
-parser = argparse.ArgumentParser(description='Find differences between ot and CoreText')
-parser.add_argument('font',
-                    help='a font file')
-parser.add_argument('recipe', help='a StringBrewer recipe file')
-
-args = parser.parse_args()
-
-ot_shaper = Vharfbuzz(args.font)
-ct_shaper = Vharfbuzz(args.font)
-ct_shaper.shapers = ["coretext"]
-
-sb = StringBrewer(from_file = args.recipe)
-
-def buffers_differ(buf1, buf2, tolerance =2):
-    outs = []
-    if len(buf1.glyph_infos) != len(buf2.glyph_infos): return True
-    for info1, info2 in zip(buf1.glyph_infos, buf2.glyph_infos):
-      if info1.codepoint != info2.codepoint: return True
-      # if info1.cluster != info2.cluster: return True
-    for pos1, pos2 in zip(buf1.glyph_positions, buf2.glyph_positions):
-      if abs(pos1.position[0] - pos2.position[0]) > tolerance: return True
-      if abs(pos1.position[1] - pos2.position[1]) > tolerance: return True
-      if abs(pos1.position[2] - pos2.position[2]) > tolerance: return True
+import hashlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+# Texts shaped before comparing the differing ones' renderings together
+BATCH_SIZE = 64
+# Seconds between progress reports
+REPORT_EVERY = 10
+
+
+class Fuzzer:
+  """A pair of shaping backends to compare, with their rasterizers."""
+
+  def __init__(self, backends, recipe, scale, threshold):
+    self.backend1, self.backend2 = [ShapingBackend(*backend) for backend in backends]
+    self.raster1 = GlyphRasterizer(self.backend1.vharfbuzz.hbfont, scale)
+    self.raster2 = GlyphRasterizer(self.backend2.vharfbuzz.hbfont, scale)
+    self.sb = StringBrewer(from_file = recipe)
+    self.threshold = threshold
+    self.seen = SeenStrings()
+
+  def differences(self, texts):
+    """Returns (text, buf1, buf2, visual difference) for each text shaped differently."""
+    pairs = list(zip(self.backend1.shape_batch(texts), self.backend2.shape_batch(texts)))
+    # Cheap comparison of glyphs and positions first; only the pairs which
+    # differ there get drawn, all together.
+    differ = buffers_differ_batch(pairs)
+    candidates = [(text, *pair) for text, pair, d in zip(texts, pairs, differ) if d]
+    vdiffs = self.raster1.visual_diffs([(buf1, buf2) for _, buf1, buf2 in candidates], self.raster2)
+    return [(*candidate, vdiff) for candidate, vdiff in zip(candidates, vdiffs)]
+
+  def score(self, text):
+    differences = self.differences([text])
+    return differences[0][3] if differences else 0
+
+  def minimize(self, text):
+    """Cuts characters out of a text for as long as the difference stays."""
+    pieces = 2
+    while len(text) > 1:
+      size = -(-len(text) // pieces)
+      for start in range(0, len(text), size):
+        candidate = text[:start] + text[start + size:]
+        if candidate and self.score(candidate) > self.threshold:
+          text = candidate
+          pieces = max(pieces - 1, 2)
+          break
+      else:
+        if size == 1:
+          break
+        pieces = min(pieces * 2, len(text))
+    return text
+
+  def fuzz(self, seed, batch, size=BATCH_SIZE):
+    """Tries a batch of ``size`` texts.
+
+    Returns how many texts were generated and how many of them were new,
+    and (minimized text, original text, score, output1, output2) for each
+    difference.
+    """
+    # Seeding each batch on its own makes a run's texts the same however
+    # many workers share it out.
+    random.seed(f"{seed}:{batch}")
+    texts = []
+    for i in range(size):
+      text = self.sb.generate()
+      if self.seen.add(text):
+        texts.append(text)
+    findings = []
+    for text, _, _, vdiff in self.differences(texts):
+      if vdiff > self.threshold:
+        minimized = self.minimize(text)
+        _, buf1, buf2, vdiff = self.differences([minimized])[0]
+        findings.append((
+          minimized, text, vdiff, self.backend1.serialize(buf1), self.backend2.serialize(buf2)
+        ))
+    return size, len(texts), findings
+
+
+# Each worker process (or the main process, when running serially) has
+# its own fuzzer.
+fuzzer = None
+
+
+def init_fuzzer(*fuzzer_args):
+  global fuzzer
+  fuzzer = Fuzzer(*fuzzer_args)
+
+
+def fuzz_batch(task):
+  return fuzzer.fuzz(*task)
+
+
+def save_finding(corpus, labels, minimized, text, vdiff, output1, output2):
+  """Writes a difference to the corpus, returning False if it was there already."""
+  path = corpus / (hashlib.sha256(minimized.encode()).hexdigest()[:16] + ".json")
+  if path.exists():
     return False
+  path.write_text(json.dumps({
+    "text": minimized, "original": text, "visual_difference": float(vdiff),
+    "shapers": labels, "outputs": [output1, output2]
+  }, ensure_ascii=False, indent=2))
+  return True
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Find differences between two shapers')
+  parser.add_argument('font',
+                      help='a font file')
+  parser.add_argument('recipe', help='a StringBrewer recipe file')
+  parser.add_argument('--shaper1', default='ot',
+                      help='HarfBuzz shaper to compare (default: ot)')
+  parser.add_argument('--shaper2',
+                      help='HarfBuzz shaper to compare it with (default: the same as'
+                      ' --shaper1 if comparing fonts or Pythons, otherwise coretext if'
+                      ' HarfBuzz has it, or else fallback)')
+  parser.add_argument('--font2', metavar='FONT',
+                      help='shape with this font the second time (default: the same font)')
+  parser.add_argument('--python1', metavar='PYTHON',
+                      help='shape with the uharfbuzz installed for this Python the first time')
+  parser.add_argument('--python2', metavar='PYTHON',
+                      help='shape with the uharfbuzz installed for this Python the second time')
+  parser.add_argument('--scale', type=float, default=0.125,
+                      help='pixels per font unit when comparing renderings (default: 0.125)')
+  parser.add_argument('--threshold', type=float, default=0.05,
+                      help='visual difference to report (default: 0.05)')
+  parser.add_argument('--jobs', '-j', type=int, default=1,
+                      help='number of worker processes (default: 1)')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='random seed (default: 0)')
+  parser.add_argument('--duration', type=float, metavar='SECONDS',
+                      help='stop after this long')
+  parser.add_argument('--iterations', type=int, metavar='N',
+                      help='stop after generating this many texts')
+  parser.add_argument('--corpus', metavar='DIR',
+                      help='save each (minimized) difference found to this directory')
+
+  args = parser.parse_args()
+
+  shaper2 = args.shaper2
+  if not shaper2 and (args.font2 or args.python1 or args.python2):
+    shaper2 = args.shaper1
+  elif not shaper2:
+    # CoreText is only there on macOS
+    try:
+      ShapingBackend(args.font, 'coretext').close()
+      shaper2 = 'coretext'
+    except ValueError:
+      shaper2 = 'fallback'
+  backends = [
+    (args.font, args.shaper1, args.python1),
+    (args.font2 or args.font, shaper2, args.python2),
+  ]
+  try:
+    # Check the backends work before starting any workers
+    checked = [ShapingBackend(*backend) for backend in backends]
+  except ValueError as e:
+    parser.error(str(e))
+  labels = [backend.label for backend in checked]
+  for backend in checked:
+    backend.close()
+  if args.font2:
+    labels[1] += f" with {args.font2}"
+
+  corpus = None
+  if args.corpus:
+    corpus = Path(args.corpus)
+    corpus.mkdir(parents=True, exist_ok=True)
+
+  start = time.monotonic()
+  deadline = None
+  if args.duration:
+    deadline = start + args.duration
+
+  # Don't let the pool queue up batches faster than they can be fuzzed,
+  # or the budgets would be spent on generating tasks.
+  in_flight = threading.Semaphore(2 * max(args.jobs, 1))
+  stopping = False
+
+  def tasks():
+    for batch in itertools.count():
+      in_flight.acquire()
+      if stopping:
+        return
+      if deadline and time.monotonic() > deadline:
+        return
+      size = BATCH_SIZE
+      if args.iterations:
+        # The last batch only makes up the number
+        size = min(size, args.iterations - batch * BATCH_SIZE)
+        if size <= 0:
+          return
+      yield args.seed, batch, size
+
+  initargs = (backends, args.recipe, args.scale, args.threshold)
+  pool = None
+  if args.jobs > 1:
+    pool = Pool(args.jobs, initializer=init_fuzzer, initargs=initargs)
+    results = pool.imap_unordered(fuzz_batch, tasks())
+  else:
+    init_fuzzer(*initargs)
+    results = map(fuzz_batch, tasks())
+
+  generated = 0
+  shaped = 0
+  found = 0
+  seen = SeenStrings()
+  last_report = start
+
+  def report():
+    elapsed = time.monotonic() - start
+    print(f"{generated} strings ({shaped} distinct) in {elapsed:.1f}s,"
+          f" {generated / max(elapsed, 1e-9):.0f} strings/s; {found} differences",
+          file=sys.stderr)
+
+  try:
+    for batch_generated, batch_shaped, findings in results:
+      in_flight.release()
+      generated += batch_generated
+      shaped += batch_shaped
+      for minimized, text, vdiff, output1, output2 in findings:
+        # Workers only know about their own texts
+        if not seen.add(minimized):
+          continue
+        if corpus and not save_finding(corpus, labels, minimized, text, vdiff, output1, output2):
+          continue
+        found += 1
+        print(f"Found a difference in {minimized} (from {text}) : (visual difference = {vdiff}%)")
+        print(f"{labels[0]}: {output1}")
+        print(f"{labels[1]}: {output2}\n")
+        sys.stdout.flush()
+      if time.monotonic() - last_report > REPORT_EVERY:
+        last_report = time.monotonic()
+        report()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    stopping = True
+    in_flight.release(2 * max(args.jobs, 1))
+    if pool:
+      pool.terminate()
+  report()
+
 
-def pad_max_shape(arrays, before=None, after=1, value=0, tie_break=np.floor):
-    shapes = np.array([x.shape for x in arrays])
-    if before is not None:
-        before = np.zeros_like(shapes) + before
-    else:
-        before = np.ones_like(shapes) - after
-    max_size = shapes.max(axis=0, keepdims=True)
-    margin = (max_size - shapes)
-    pad_before = tie_break(margin * before.astype(float)).astype(int)
-    pad_after = margin - pad_before
-    pad = np.stack([pad_before, pad_after], axis=2)
-    return [np.pad(x, w, mode='constant', constant_values=value) for x, w in zip(arrays, pad)]
-
-def visual_diff(s1, buf1, s2, buf2):
-  png1 = cairosvg.svg2png(bytestring=s1.buf_to_svg(buf1))
-  png2 = cairosvg.svg2png(bytestring=s2.buf_to_svg(buf2))
-  im1 = imageio.imread(png1).sum(axis=2)
-  im2 = imageio.imread(png2).sum(axis=2)
-  padded = pad_max_shape([im1,im2])
-  diff = padded[0]-padded[1]
-  total_diff = np.sum(np.abs(diff))
-  return (total_diff / (im1.shape[0] * im1.shape[1]) * 100)
-
-while True:
-  text = sb.generate()
-  ot_buf = ot_shaper.shape(text)
-  ct_buf = ct_shaper.shape(text)
-  ot = ot_shaper.serialize_buf(ot_buf)
-  ct = ct_shaper.serialize_buf(ct_buf)
-  if buffers_differ(ot_buf, ct_buf):
-    vdiff = visual_diff(ot_shaper, ot_buf, ct_shaper, ct_buf)
-    if vdiff > 0.05:
-      print(f"Found a difference in {text} : (visual difference = {vdiff}%)")
-      print(f"OT: {ot}")
-      print(f"CT: {ct}\n")
+if __name__ == "__main__":
+  main()
@@ -1,7 +1,7 @@
-from collections import defaultdict
+from array import array
 import argparse
-import random
 import sys
+import numpy as np
 
 parser = argparse.ArgumentParser(
     description="Turn a wordlist into a set of kerning words"
@@ -17,6 +17,21 @@ parser.add_argument(
     help="List words with the character of interest on the left and words"
     " with the character on the right separately",
 )
+parser.add_argument(
+    "--min-length", type=int, default=0, help="shortest word to use (default: any)"
+)
+parser.add_argument(
+    "--max-length", type=int, default=None, help="longest word to use (default: any)"
+)
+parser.add_argument(
+    "--counts",
+    action="store_true",
+    help="each line of the wordlist is a word and how common it is, separated"
+    " by whitespace (default: count how often each word appears)",
+)
+parser.add_argument(
+    "--seed", type=int, default=0, help="random seed, for other choices of words (default: 0)"
+)
 
 parser.add_argument("wordlist", metavar="FILE", help="the wordlist file")
 
@@ -28,13 +43,67 @@ except Exception as e:
     print(f"Couldn't open wordlist: {e}")
     sys.exit(1)
 
+# Each word is kept once, and the index maps each bigram to the IDs of the
+# words containing it
 all_letters = set()
-ngrams = defaultdict(set)
-for word in fh:
-    word = word.rstrip()
-    for i in range(max(1, len(word) - 1)):
-        ngrams[word[i : i + 2]].add(word)
+word_ids = {}
+words = []
+counts = array("q")
+ngrams = {}
+for line_number, line in enumerate(fh, 1):
+    if not line.strip():
+        continue
+    if args.counts:
+        # The word itself may have spaces in it
+        fields = line.rsplit(None, 1)
+        try:
+            word, count = fields[0].strip(), int(fields[1])
+        except (IndexError, ValueError):
+            print(f"Skipping line {line_number}: not a word and a count", file=sys.stderr)
+            continue
+    else:
+        word, count = line.rstrip(), 1
+    if word in word_ids:
+        counts[word_ids[word]] += count
+        continue
+    word_id = word_ids[word] = len(words)
+    words.append(word)
+    counts.append(count)
+    for ngram in {word[i : i + 2] for i in range(len(word) - 1)}:
+        if ngram not in ngrams:
+            ngrams[ngram] = array("I")
+        ngrams[ngram].append(word_id)
     all_letters.update(word)
+del word_ids
+
+lengths = np.array([len(word) for word in words])
+usable = lengths >= args.min_length
+if args.max_length is not None:
+    usable &= lengths <= args.max_length
+# Shorter and more common words are more likely to be chosen; words with
+# no frequency at all never are
+weights = np.array(counts, dtype=np.float64) / np.maximum(lengths, 1)
+usable &= weights > 0
+rng = np.random.default_rng(args.seed)
+
+
+def choose(ngram):
+    """Picks a word containing the bigram, or None if there isn't one.
+
+    Each candidate gets a random key weighted by how likely it should be
+    to be chosen, and the word with the largest key wins, just as if they
+    had gone through a weighted reservoir sample."""
+    if ngram not in ngrams:
+        return None
+    candidates = np.frombuffer(ngrams[ngram], dtype=np.uint32)
+    candidates = candidates[usable[candidates]]
+    if not len(candidates):
+        return None
+    # log(u) / w orders the keys as u ** (1 / w) would, without underflowing
+    # for large weights (u is in (0, 1], so the log is finite)
+    keys = np.log(1 - rng.random(len(candidates))) / weights[candidates]
+    return words[candidates[np.argmax(keys)]]
+
 
 if not args.alphabet:
     args.alphabet = all_letters
@@ -47,14 +116,14 @@ for first in sorted(args.alphabet):
         line1 = [first]
         line2 = line1
     for second in sorted(args.alphabet):
-        candidates = ngrams.get(first + second)
-        if candidates:
-            line1.append(random.choice(list(candidates)))
+        chosen = choose(first + second)
+        if chosen:
+            line1.append(chosen)
         if first == second:
             continue
-        candidates = ngrams.get(second + first)
-        if candidates:
-            line2.append(random.choice(list(candidates)))
+        chosen = choose(second + first)
+        if chosen:
+            line2.append(chosen)
     if args.separate_sides:
         line1.append(first + "+")
         print(" ".join(line1))
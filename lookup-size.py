@@ -1,9 +1,44 @@
 from fontTools.ttLib import TTFont
-from fontTools.ttLib.tables.otBase import OTTableWriter
-import sys
 from fontTools.feaLib.lookupDebugInfo import LOOKUP_DEBUG_INFO_KEY
+from lookuplayout import LookupLayout, font_salt, lookup_digest, plan
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import json
+import os
+import sys
+
+TABLES = ["GSUB", "GPOS"]
+# Bumped whenever what is kept for each lookup changes
+CACHE_VERSION = 2
+# The cache is shared between fonts; beyond this many lookups, the least
+# recently measured are dropped
+MAX_CACHED_LOOKUPS = 50_000
+
+# Each worker process (or the main process, when running serially) opens
+# the font lazily, so only decompiles the lookups it is given.
+font = None
+salt = None
+cache = None
+
+
+def init_worker(filename, known):
+    global font, salt, cache
+    font = TTFont(filename, lazy=True)
+    salt = font_salt(font)
+    cache = known
+
+
+def measure(task):
+    """Returns a lookup's digest and summary."""
+    table, ix = task
+    lookup = font[table].table.LookupList.Lookup[ix]
+    digest = lookup_digest(lookup, salt)
+    if digest in cache:
+        return table, ix, digest, cache[digest]
+    layout = LookupLayout.compile(lookup, font, table)
+    return table, ix, digest, layout.summary(lookup, table)
 
-font = TTFont(sys.argv[1])
 
 def locate(table, ix):
     if "Debg" not in font:
@@ -13,22 +48,151 @@ def locate(table, ix):
         return f"{ix} = {debg[0]} ({debg[1]})"
     return str(ix)
 
-for table in ["GSUB", "GPOS"]:
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base, "font-engineering", "lookup-size.json")
+
+
+def load_cache(path):
+    if not path or not path.exists():
+        return {}
+    cached = json.loads(path.read_text())
+    if cached.get("version") != CACHE_VERSION:
+        return {}
+    return cached["lookups"]
+
+
+def describe_overflows(overflows):
+    grouped = {}
+    for _, parent, child, distance in overflows:
+        count, furthest = grouped.get((parent, child), (0, 0))
+        grouped[(parent, child)] = (count + 1, max(furthest, distance))
+    return [
+        f"{count} offsets from {parent} to {child} overflow (up to {furthest})"
+        for (parent, child), (count, furthest) in grouped.items()
+    ]
+
+
+def report_plan(table, summaries):
+    """Prints the overflows predicted for a table and how to avoid them.
+
+    Returns True if there were any."""
+    late, promote, split, fits = plan(summaries)
+    overflowing = [ix for ix, summary in enumerate(summaries) if summary["overflows"]]
+    if not (late or overflowing):
+        print(f"{table}: no overflows predicted")
+        return False
     print(f"{table} table")
     print("==========\n")
-    lookups = font.get(table).table.LookupList.Lookup
-    sizes = []
-    for ix, lookup in enumerate(lookups):
-        writer = OTTableWriter()
-        lookup.compile(writer, font)
-        try:
-            size = len(writer.getAllData())
-        except:
-            size = 123456789
-        sizes.append((locate(table, ix), size))
-
-    for location, size in (list(sorted(sizes, key=lambda a:-a[1])))[0:10]:
-        if size == 123456789:
-            print(location, "\t(overflowed)")
-        else:
-            print(location, "\t", size)
+    print("Predicted overflows:")
+    for ix in overflowing:
+        for description in describe_overflows(summaries[ix]["overflows"]):
+            print(f"  {locate(table, ix)}: {description}")
+    if late:
+        print(f"  LookupList: {len(late)} offsets to lookups overflow, from {locate(table, late[0])}")
+    if split:
+        print("\nSplit these subtables (with a `subtable;` statement):")
+        for ix, subtable in split:
+            print(f"  subtable {subtable} of {locate(table, ix)}")
+    if promote:
+        print("\nPromote these lookups to Extension lookups (`lookup NAME useExtension {`):")
+        for ix in promote:
+            print(f"  {locate(table, ix)}")
+    if not fits:
+        print("\nEven then the LookupList is too big; some lookups will need to be made smaller.")
+    print()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the largest GSUB and GPOS lookups")
+    parser.add_argument("font", help="Font file")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of lookups to show for each table (0 for all; default: 10)")
+    parser.add_argument("--subtables", action="store_true",
+                        help="Show how each lookup's size splits between its subtables")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes (default: 1)")
+    parser.add_argument("--cache",
+                        help="File to keep lookup sizes in between runs"
+                        " (default: ~/.cache/font-engineering/lookup-size.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Measure every lookup again")
+    parser.add_argument("--plan", action="store_true",
+                        help="Instead of listing lookups, predict offset overflows and say which lookups"
+                        " to promote to Extension lookups or split to avoid them (exits with status 1"
+                        " if there are any)")
+    args = parser.parse_args()
+
+    cache_path = None if args.no_cache else Path(args.cache or default_cache_path())
+    known = load_cache(cache_path)
+    initargs = (args.font, known)
+    init_worker(*initargs)
+    tasks = [
+        (table, ix)
+        for table in TABLES if table in font
+        for ix in range(font[table].table.LookupList.LookupCount)
+    ]
+
+    pool = None
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_worker, initargs=initargs)
+        results = pool.imap_unordered(measure, tasks)
+    else:
+        results = map(measure, tasks)
+
+    sizes = {table: [] for table in TABLES}
+    measured = {}
+    for table, ix, digest, result in results:
+        sizes[table].append((ix, result))
+        measured[digest] = result
+    if pool:
+        pool.close()
+    if cache_path:
+        # This font's lookups go first, so other fonts' are dropped first
+        for digest, result in known.items():
+            if len(measured) >= MAX_CACHED_LOOKUPS:
+                break
+            measured.setdefault(digest, result)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name first, so runs at the same time
+        # never read half a cache
+        tmp_path = Path(f"{cache_path}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"version": CACHE_VERSION, "lookups": measured}))
+        os.replace(tmp_path, cache_path)
+
+    if args.plan:
+        found = False
+        for table in TABLES:
+            if table in font:
+                summaries = [result for _, result in sorted(sizes[table], key=lambda a: a[0])]
+                found = report_plan(table, summaries) or found
+        sys.exit(1 if found else 0)
+
+    for table in TABLES:
+        if table not in font:
+            continue
+        print(f"{table} table")
+        print("==========\n")
+        largest = sorted(sizes[table], key=lambda a: (-a[1]["size"], a[0]))
+        if args.top:
+            largest = largest[:args.top]
+        for ix, result in largest:
+            if result["overflows"]:
+                print(locate(table, ix), "\t", result["size"], "(overflows)")
+            else:
+                print(locate(table, ix), "\t", result["size"])
+            if not args.subtables:
+                continue
+            for subtable, (label, size) in enumerate(result["subtables"]):
+                print(f"    subtable {subtable} ({label})\t{size}")
+            shared, shared_count = result["shared"]
+            if shared_count:
+                print(f"    shared between subtables ({shared_count} tables)\t{shared}")
+            for description in describe_overflows(result["overflows"]):
+                print(f"    {description}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Remember which lookups each test string depends on, to skip reshaping.
+
+When a test string is shaped, we note every glyph which appeared in the
+buffer between lookups, and which lookups actually changed it. A lookup can
+only affect a string if a glyph in its coverage turns up in the buffer, so
+after the font is rebuilt we compare its lookups with the ones recorded last
+time: strings which never saw a glyph covered by any changed lookup (in
+either version of it) must shape exactly as before, and their old results
+can be taken from the shaping cache instead of shaping them again.
+
+Anything outside the lookups themselves (scripts, features, GDEF, cmap,
+metrics, glyph order...) changing means everything gets reshaped.
+"""
+import hashlib
+import json
+import uharfbuzz as hb
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables.otBase import OTTableWriter, BaseTable
+from fontTools.misc.xmlWriter import XMLWriter
+from io import BytesIO
+from shapecache import shaping_tables
+
+
+def _compiled(table, font, tag):
+    writer = OTTableWriter(tableTag=tag)
+    try:
+        table.compile(writer, font)
+        return writer.getAllData()
+    except Exception:
+        # Too big to compile on its own (offset overflow); the XML will do
+        out = BytesIO()
+        table.toXML(XMLWriter(out), font)
+        return out.getvalue()
+
+
+def _subtables(lookup):
+    for subtable in lookup.SubTable:
+        yield getattr(subtable, "ExtSubTable", subtable)
+
+
+def _coverage(subtable):
+    """Glyph names a subtable can start matching at, or None for "any"."""
+    for attr in ["mapping", "alternates", "ligatures"]:
+        if hasattr(subtable, attr):
+            return set(getattr(subtable, attr).keys())
+    for attr in ["Coverage", "InputCoverage", "MarkCoverage"]:
+        coverage = getattr(subtable, attr, None)
+        if isinstance(coverage, list):
+            coverage = coverage[0] if coverage else None
+        if coverage is not None:
+            return set(coverage.glyphs)
+    return None
+
+
+def _nested_lookups(table):
+    """Indices of lookups called from (chain) contextual rules."""
+    found = set()
+    stack = [table]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, list):
+            stack.extend(obj)
+        elif isinstance(obj, BaseTable):
+            if hasattr(obj, "LookupListIndex") and hasattr(obj, "SequenceIndex"):
+                found.add(obj.LookupListIndex)
+            stack.extend(
+                value
+                for value in vars(obj).values()
+                if isinstance(value, (list, BaseTable))
+            )
+    return found
+
+
+def layout_summary(filename):
+    """Describes a font's layout for comparison with a later build.
+
+    Returns a hash of everything except the GSUB and GPOS lookups, and for
+    each lookup in those tables a hash, its coverage (as glyph IDs, or None
+    for "any glyph") and the lookups it calls.
+    """
+    font = TTFont(filename)
+    glyph_ids = font.getReverseGlyphMap()
+    digest = hashlib.sha256(hb.version_string().encode())
+    digest.update(" ".join(font.getGlyphOrder()).encode())
+    digest.update(str(font["head"].unitsPerEm).encode())
+    for tag in shaping_tables(font):
+        if tag not in ["GSUB", "GPOS"]:
+            digest.update(tag.encode())
+            digest.update(font.reader[tag])
+    lookups = {}
+    for tag in ["GSUB", "GPOS"]:
+        lookups[tag] = []
+        if tag not in font:
+            continue
+        table = font[tag].table
+        for part in ["ScriptList", "FeatureList", "FeatureVariations"]:
+            if getattr(table, part, None):
+                digest.update(_compiled(getattr(table, part), font, tag))
+        if not table.LookupList:
+            continue
+        for lookup in table.LookupList.Lookup:
+            coverage = set()
+            for subtable in _subtables(lookup):
+                subtable_coverage = _coverage(subtable)
+                if subtable_coverage is None:
+                    coverage = None
+                    break
+                coverage |= subtable_coverage
+            if coverage is not None:
+                coverage = sorted(glyph_ids[g] for g in coverage)
+            lookups[tag].append(
+                {
+                    "hash": hashlib.sha256(_compiled(lookup, font, tag)).hexdigest(),
+                    "coverage": coverage,
+                    "calls": sorted(_nested_lookups(list(_subtables(lookup)))),
+                }
+            )
+    font.close()
+    return {"layout": digest.hexdigest(), "lookups": lookups}
+
+
+def changed_glyphs(old, new):
+    """Glyph IDs which could shape differently between two layout summaries.
+
+    Returns None if anything could have changed."""
+    if old["layout"] != new["layout"]:
+        return None
+    glyphs = set()
+    for tag in ["GSUB", "GPOS"]:
+        old_lookups, new_lookups = old["lookups"][tag], new["lookups"][tag]
+        if len(old_lookups) != len(new_lookups):
+            return None
+        changed = {
+            ix
+            for ix, (o, n) in enumerate(zip(old_lookups, new_lookups))
+            if o["hash"] != n["hash"]
+        }
+        # A lookup which calls a changed one changes too, because nested
+        # lookups can act on glyphs that never survive to a lookup boundary.
+        while True:
+            callers = {
+                ix
+                for ix, n in enumerate(new_lookups)
+                if ix not in changed and changed.intersection(n["calls"])
+            }
+            if not callers:
+                break
+            changed |= callers
+        for ix in changed:
+            for lookup in [old_lookups[ix], new_lookups[ix]]:
+                if lookup["coverage"] is None:
+                    return None
+                glyphs.update(lookup["coverage"])
+    return glyphs
+
+
+def trace_shape(vharfbuzz, text, parameters=None):
+    """Shapes a text as ``Vharfbuzz.shape`` does, watching lookups apply.
+
+    Returns the buffer, the set of glyph IDs seen in the buffer at any
+    lookup boundary, and a list of [table, lookup index] for each lookup
+    which changed the buffer.
+    """
+    if not parameters:
+        parameters = {}
+    buf = hb.Buffer()
+    buf.add_str(text)
+    buf.guess_segment_properties()
+    for el in ["script", "direction", "language"]:
+        if parameters.get(el):
+            setattr(buf, el, parameters[el])
+    shapers = vharfbuzz.shapers
+    if parameters.get("shaper"):
+        shapers = [parameters["shaper"]]
+
+    seen = set()
+    fired = []
+    state = {"table": "GSUB", "before": None}
+
+    def snapshot():
+        glyphs = tuple(info.codepoint for info in buf.glyph_infos)
+        seen.update(glyphs)
+        if state["table"] == "GPOS":
+            return glyphs, tuple(tuple(pos.position) for pos in buf.glyph_positions)
+        return glyphs
+
+    def message(msg):
+        if msg.startswith("start table GPOS"):
+            state["table"] = "GPOS"
+        elif msg.startswith("start lookup"):
+            state["before"] = snapshot()
+        elif msg.startswith("end lookup"):
+            if snapshot() != state["before"]:
+                fired.append([state["table"], int(msg.split()[2])])
+        return True
+
+    buf.set_message_func(message)
+    hb.shape(vharfbuzz.hbfont, buf, parameters.get("features"), shapers=shapers)
+    seen.update(info.codepoint for info in buf.glyph_infos)
+    # As Vharfbuzz.shape leaves it, so that serialize_buf shows positions
+    vharfbuzz.stage = "GPOS"
+    return buf, seen, fired
+
+
+class LookupIndex:
+    """Per-string lookup records for one font, kept in a JSON file.
+
+    The file can hold records for several fonts (keyed by file name), so
+    that a family can share one test corpus.
+
+    Args:
+        path: The index file.
+        shaper: The ``CachedShaper`` to shape with. Old results can only be
+            reused if it has a cache.
+    """
+
+    def __init__(self, path, shaper):
+        self.path = path
+        self.shaper = shaper
+        self.fontname = str(shaper.vharfbuzz.filename).split("/")[-1]
+        previous = self.load().get(self.fontname, {})
+        self.strings = previous.get("strings", {})
+        # Summaries of every build some string was last shaped with
+        self.summaries = previous.get("summaries", {})
+        self.summary = layout_summary(shaper.vharfbuzz.filename)
+        self.summaries[shaper.fonthash] = self.summary
+        self._changed = {}
+        self.reused = 0
+        self.reshaped = 0
+
+    def changed_since(self, fonthash):
+        if fonthash not in self._changed:
+            self._changed[fonthash] = None
+            if fonthash in self.summaries:
+                self._changed[fonthash] = changed_glyphs(
+                    self.summaries[fonthash], self.summary
+                )
+        return self._changed[fonthash]
+
+    def shape(self, text, parameters):
+        cache = self.shaper.cache
+        fonthash = self.shaper.fonthash
+        key = hashlib.sha256(
+            json.dumps([text, parameters], sort_keys=True).encode()
+        ).hexdigest()
+        entry = self.strings.get(key)
+        if entry and cache:
+            # Unchanged since we last traced it?
+            if entry["font"] == fonthash:
+                buf = self.shaper.shape(text, parameters)
+                self.reused += 1
+                return buf
+            # Or only changed in ways which can't affect this string?
+            changed = self.changed_since(entry["font"])
+            if changed is not None and not changed.intersection(entry["glyphs"]):
+                buf = cache.get(entry["font"], text, parameters)
+                if buf is not None:
+                    cache.put(fonthash, text, parameters, buf)
+                    entry["font"] = fonthash
+                    self.shaper.vharfbuzz.stage = "GPOS"
+                    self.reused += 1
+                    return buf
+        buf, seen, fired = trace_shape(self.shaper.vharfbuzz, text, parameters)
+        if cache:
+            cache.put(fonthash, text, parameters, buf)
+        self.strings[key] = {"font": fonthash, "glyphs": sorted(seen), "lookups": fired}
+        self.reshaped += 1
+        return buf
+
+    def load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # Other fonts' records may have been updated since we loaded ours
+        everything = self.load()
+        in_use = {entry["font"] for entry in self.strings.values()}
+        everything[self.fontname] = {
+            "summaries": {
+                fonthash: summary
+                for fonthash, summary in self.summaries.items()
+                if fonthash in in_use
+            },
+            "strings": self.strings,
+        }
+        self.path.write_text(json.dumps(everything))
@@ -0,0 +1,248 @@
+"""Models how GSUB and GPOS lookups are laid out when compiled.
+
+fontTools compiles a lookup into a tree of ``OTTableWriter`` objects, merges
+duplicate subtables, puts the tables in order and only then packs the
+offsets between them, which is where an overflow is found. Doing all but
+that last step tells us a lookup's size, how it splits between its
+subtables (and what they share) and which offsets are too big, without
+the compile failing.
+
+    layout = LookupLayout.compile(lookup, font, "GPOS")
+    print(layout.size, layout.overflows())
+
+``lookup_digest`` hashes a lookup's contents, so that measurements can be
+kept between runs and only changed lookups measured again.
+
+``plan`` puts a table's lookup summaries together to predict which offsets
+overflow when the whole table is compiled, and which lookups to promote to
+Extension lookups (or subtables to split) so that none do. fontTools finds
+these one overflow, and one full compile, at a time. The model follows
+fontTools' own packer, but doesn't know about tables shared between
+lookups, so it errs on the side of predicting an overflow.
+"""
+import hashlib
+import fontTools
+from fontTools.ttLib.tables.otBase import OTTableWriter
+
+# Largest value of a 16-bit offset
+MAX_OFFSET = 0xFFFF
+# Size of an Extension subtable (format, lookup type, 32-bit offset)
+EXTENSION_SUBTABLE = 8
+EXTENSION_TYPES = {"GSUB": 7, "GPOS": 9}
+
+
+def _feed(digest, obj):
+    if isinstance(obj, (list, tuple)):
+        digest.update(b"[")
+        for item in obj:
+            _feed(digest, item)
+        digest.update(b"]")
+    elif isinstance(obj, dict):
+        digest.update(b"{")
+        for key in sorted(obj):
+            _feed(digest, key)
+            _feed(digest, obj[key])
+        digest.update(b"}")
+    elif hasattr(obj, "__dict__"):
+        if hasattr(obj, "ensureDecompiled"):
+            obj.ensureDecompiled()
+        digest.update(type(obj).__name__.encode() + b"(")
+        for key, value in sorted(vars(obj).items()):
+            # Lazily loaded tables keep their reader and font around
+            if key in ("reader", "font") or key.startswith("_"):
+                continue
+            digest.update(key.encode() + b"=")
+            _feed(digest, value)
+        digest.update(b")")
+    else:
+        digest.update(repr(obj).encode() + b",")
+
+
+def font_salt(font):
+    """What, besides a lookup itself, decides how it compiles."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(fontTools.version.encode())
+    _feed(digest, font.getGlyphOrder())
+    return digest.hexdigest()
+
+
+def lookup_digest(lookup, salt=""):
+    """A hash of everything in a lookup which goes into compiling it."""
+    digest = hashlib.blake2b(salt.encode(), digest_size=16)
+    _feed(digest, lookup)
+    return digest.hexdigest()
+
+
+def subtable_label(subtable):
+    if hasattr(subtable, "ExtSubTable"):
+        subtable = subtable.ExtSubTable
+    label = type(subtable).__name__
+    if hasattr(subtable, "Format"):
+        label += f" format {subtable.Format}"
+    return label
+
+
+class LookupLayout:
+    """A compiled lookup's tables, in the order fontTools would write them.
+
+    Args:
+        writer: An ``OTTableWriter`` which a lookup has been compiled into.
+    """
+
+    def __init__(self, writer):
+        writer._doneWriting({})
+        tables = []
+        ext_tables = []
+        writer._gatherTables(tables, ext_tables, {})
+        tables.reverse()
+        ext_tables.reverse()
+        self.root = writer
+        self.tables = tables + ext_tables
+        pos = 0
+        for ix, table in enumerate(self.tables):
+            if ix == len(tables):
+                # Extension subtables go after everything else in the table
+                self.main_size = pos
+            table.pos = pos
+            pos += table.getDataLength()
+        if not ext_tables:
+            self.main_size = pos
+        self.size = pos
+
+    @classmethod
+    def compile(cls, lookup, font, table_tag):
+        writer = OTTableWriter(tableTag=table_tag)
+        writer.name = "Lookup"
+        lookup.compile(writer, font)
+        return cls(writer)
+
+    @staticmethod
+    def children(table):
+        return [item.subWriter for item in table.items if hasattr(item, "subWriter")]
+
+    def reachable(self, table):
+        """Every table under (and including) a table, by id."""
+        seen = {}
+        stack = [table]
+        while stack:
+            table = stack.pop()
+            if id(table) not in seen:
+                seen[id(table)] = table
+                stack.extend(self.children(table))
+        return seen
+
+    def overflows(self):
+        """Returns (subtable, parent name, child name, distance) for each
+        16-bit offset too big to pack.
+
+        ``subtable`` is the index of the subtable the offset is in, or
+        points to."""
+        owner = {}
+        for ix, subtable in reversed(list(enumerate(self.children(self.root)))):
+            owner.update(dict.fromkeys(self.reachable(subtable), ix))
+        found = []
+        for table in self.tables:
+            for item in table.items:
+                if not hasattr(item, "subWriter") or item.offsetSize != 2:
+                    continue
+                distance = item.subWriter.pos - table.pos
+                if distance > MAX_OFFSET:
+                    found.append(
+                        (owner[id(item.subWriter)], table.name, item.subWriter.name, distance)
+                    )
+        return found
+
+    def breakdown(self):
+        """Splits the lookup's size between its subtables.
+
+        Returns the size of what is only reachable from each subtable, and
+        the size and number of the tables reachable from more than one."""
+        subtables = [self.reachable(subtable) for subtable in self.children(self.root)]
+        users = {}
+        for reachable in subtables:
+            for key in reachable:
+                users[key] = users.get(key, 0) + 1
+        owned = [
+            sum(table.getDataLength() for key, table in reachable.items() if users[key] == 1)
+            for reachable in subtables
+        ]
+        shared = {}
+        for reachable in subtables:
+            for key, table in reachable.items():
+                if users[key] > 1:
+                    shared[key] = table.getDataLength()
+        return owned, sum(shared.values()), len(shared)
+
+    def summary(self, lookup, table_tag):
+        """What ``plan`` (and lookup-size.py) need to know about a lookup."""
+        owned, shared, shared_count = self.breakdown()
+        return {
+            "size": self.size,
+            "main": self.main_size,
+            "header": self.root.getDataLength(),
+            "extension": lookup.LookupType == EXTENSION_TYPES[table_tag],
+            "overflows": self.overflows(),
+            "subtables": [
+                [subtable_label(subtable), size]
+                for subtable, size in zip(lookup.SubTable, owned)
+            ],
+            "shared": [shared, shared_count],
+        }
+
+
+def promoted_size(summary):
+    """How much of the table before the Extension subtables a lookup would take up as an Extension lookup."""
+    if summary["extension"]:
+        return summary["main"]
+    return summary["header"] + EXTENSION_SUBTABLE * len(summary["subtables"])
+
+
+def plan(summaries):
+    """Predicts a table's overflows from its lookups' summaries, and how to avoid them.
+
+    Returns the indices of the lookups more than 64K into the LookupList,
+    the lookups to promote to Extension lookups, the (lookup, subtable)
+    pairs to split, and whether promoting those lookups is enough.
+
+    A lookup whose offsets to its subtables overflow has to be promoted;
+    an overflow inside a subtable can only be fixed by splitting it. After
+    that, the lookups which save the most by being promoted are promoted
+    until the last lookup starts within reach of the LookupList."""
+    promote = set()
+    split = set()
+    for ix, summary in enumerate(summaries):
+        for subtable, parent, _, _ in summary["overflows"]:
+            if parent == "Lookup":
+                promote.add(ix)
+            else:
+                split.add((ix, subtable))
+
+    def offsets():
+        # The LookupList is followed by each lookup in turn
+        offset = 2 + 2 * len(summaries)
+        found = []
+        for ix, summary in enumerate(summaries):
+            found.append(offset)
+            offset += promoted_size(summary) if ix in promote else summary["main"]
+        return found
+
+    late = [ix for ix, offset in enumerate(offsets()) if offset > MAX_OFFSET]
+    fits = True
+    if late:
+        last = late[-1]
+        excess = offsets()[last] - MAX_OFFSET
+        savings = sorted(
+            (
+                (summaries[ix]["main"] - promoted_size(summaries[ix]), ix)
+                for ix in range(last)
+                if ix not in promote
+            ),
+            reverse=True,
+        )
+        for saving, ix in savings:
+            if excess <= 0:
+                break
+            promote.add(ix)
+            excess -= saving
+        fits = excess <= 0
+    return late, sorted(promote), sorted(split), fits
@@ -0,0 +1,134 @@
+"""Spread the shaping of many test strings across worker processes.
+
+Each worker opens the font once and then shapes (and, if asked,
+collision-checks) whole chunks of strings. Results come back in the order the
+strings were submitted, so reports built from them don't depend on how the
+work happened to be scheduled.
+"""
+import json
+import threading
+from itertools import islice
+from multiprocessing import Pool
+from vharfbuzz import Vharfbuzz
+from collidoscope import Collidoscope
+
+DEFAULT_CHUNK_SIZE = 250
+
+# Per-worker state, set up by _init_worker
+_filename = None
+_vharfbuzz = None
+_collidoscopes = {}
+
+
+def _init_worker(filename):
+    global _filename, _vharfbuzz
+    _filename = filename
+    _vharfbuzz = Vharfbuzz(filename)
+    _collidoscopes.clear()
+
+
+def _get_collidoscope(rules, direction):
+    key = (json.dumps(rules, sort_keys=True), direction)
+    if key not in _collidoscopes:
+        _collidoscopes[key] = Collidoscope(_filename, rules, direction=direction)
+    return _collidoscopes[key]
+
+
+def _forbidden_chunk(task):
+    parameters, forbidden_glyphs, strings = task
+    results = []
+    for text in strings:
+        buf = _vharfbuzz.shape(text, parameters)
+        glyph_names = _vharfbuzz.serialize_buf(buf, glyphsonly=True).split("|")
+        results.append([f for f in forbidden_glyphs if f in glyph_names])
+    return results
+
+
+def _collides_chunk(task):
+    parameters, rules, direction, allowed_collisions, strings = task
+    col = _get_collidoscope(rules, direction)
+    results = []
+    for text in strings:
+        buf = _vharfbuzz.shape(text, parameters)
+        glyphs = col.get_glyphs(text, buf=buf)
+        collisions = col.has_collisions(glyphs)
+        bumps = [f"{c.glyph1}/{c.glyph2}" for c in collisions]
+        bumps = [b for b in bumps if b not in allowed_collisions]
+        draw = None
+        if bumps:
+            draw = col.draw_overlaps(glyphs, collisions)
+        results.append((bumps, draw))
+    return results
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ShapingPool:
+    """A pool of worker processes, each holding its own copy of one font.
+
+    Args:
+        filename: The font file each worker should open.
+        jobs: Number of worker processes.
+        chunk_size: Number of strings sent to a worker at a time.
+    """
+
+    def __init__(self, filename, jobs, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.pool = Pool(jobs, initializer=_init_worker, initargs=(str(filename),))
+
+    def _map(self, func, make_task, strings):
+        chunks = chunked(strings, self.chunk_size)
+        # Keep each chunk's strings on this side; only results travel back.
+        pending = []
+        # The pool would otherwise pull every chunk out of the strings up
+        # front, so don't let submission get more than a few chunks ahead.
+        in_flight = threading.Semaphore(2 * self.jobs)
+        stopping = False
+
+        def tasks():
+            for chunk in chunks:
+                in_flight.acquire()
+                if stopping:
+                    return
+                pending.append(chunk)
+                yield make_task(chunk)
+
+        try:
+            for results in self.pool.imap(func, tasks()):
+                in_flight.release()
+                chunk = pending.pop(0)
+                yield from zip(chunk, results)
+        finally:
+            # If the caller stops early, let the task generator see it should
+            # stop, rather than leave it blocking the pool's task handler.
+            stopping = True
+            in_flight.release(2 * self.jobs)
+
+    def forbidden(self, strings, parameters, forbidden_glyphs):
+        """Yields (text, forbidden glyphs found) for each string, in order."""
+        return self._map(
+            _forbidden_chunk,
+            lambda chunk: (parameters, forbidden_glyphs, chunk),
+            strings,
+        )
+
+    def collisions(self, strings, parameters, rules, direction, allowed_collisions):
+        """Yields (text, bumps, overlap drawing) for each string, in order."""
+        for text, (bumps, draw) in self._map(
+            _collides_chunk,
+            lambda chunk: (parameters, rules, direction, allowed_collisions, chunk),
+            strings,
+        ):
+            yield text, bumps, draw
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
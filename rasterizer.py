@@ -0,0 +1,185 @@
+"""Draws shaped text into NumPy arrays, for comparing renderings quickly.
+
+Each glyph is rasterized once (filled with the nonzero rule, sampling at
+pixel centres) and kept by glyph ID; a shaped run is then built by copying
+those rasters into place. Runs are compared in batches: every pair is drawn
+into a frame covering both renderings, and the frames are stacked so that
+all the scores come out of one array operation.
+
+    raster = GlyphRasterizer(vharfbuzz.hbfont, scale=0.125)
+    scores = raster.visual_diffs([(buf1, buf2), (buf3, buf4)])
+"""
+import numpy as np
+from fontTools.pens.basePen import BasePen
+
+# Curves are flattened into this many straight segments
+STEPS = np.linspace(0, 1, 9)[1:]
+
+
+class FlatteningPen(BasePen):
+    """Collects a glyph's outline as straight edges (x0, y0, x1, y1)."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.edges = []
+        self.start = None
+
+    def _moveTo(self, pt):
+        self.start = pt
+
+    def _lineTo(self, pt):
+        self.edges.append((*self._getCurrentPoint(), *pt))
+
+    def _polyline(self, xs, ys):
+        x0, y0 = self._getCurrentPoint()
+        xs = np.concatenate([[x0], xs])
+        ys = np.concatenate([[y0], ys])
+        self.edges.extend(zip(xs[:-1], ys[:-1], xs[1:], ys[1:]))
+
+    def _qCurveToOne(self, pt1, pt2):
+        (x0, y0), (x1, y1), (x2, y2) = self._getCurrentPoint(), pt1, pt2
+        t, u = STEPS, 1 - STEPS
+        self._polyline(
+            u * u * x0 + 2 * u * t * x1 + t * t * x2,
+            u * u * y0 + 2 * u * t * y1 + t * t * y2,
+        )
+
+    def _curveToOne(self, pt1, pt2, pt3):
+        (x0, y0), (x1, y1), (x2, y2), (x3, y3) = (
+            self._getCurrentPoint(), pt1, pt2, pt3
+        )
+        t, u = STEPS, 1 - STEPS
+        self._polyline(
+            u**3 * x0 + 3 * u * u * t * x1 + 3 * u * t * t * x2 + t**3 * x3,
+            u**3 * y0 + 3 * u * u * t * y1 + 3 * u * t * t * y2 + t**3 * y3,
+        )
+
+    def _closePath(self):
+        current = self._getCurrentPoint()
+        if current != self.start:
+            self.edges.append((*current, *self.start))
+
+    _endPath = _closePath
+
+
+def fill(edges):
+    """Rasterizes edges (in pixels) with the nonzero winding rule.
+
+    Returns a boolean array, indexed [row, column] with row 0 at the
+    bottom, and the pixel position of its bottom left corner."""
+    if not len(edges):
+        return np.zeros((0, 0), dtype=bool), (0, 0)
+    x0, y0, x1, y1 = edges.T
+    left = int(np.floor(min(x0.min(), x1.min())))
+    bottom = int(np.floor(min(y0.min(), y1.min())))
+    width = int(np.ceil(max(x0.max(), x1.max()))) - left
+    height = int(np.ceil(max(y0.max(), y1.max()))) - bottom
+    sloped = y0 != y1
+    x0, y0, x1, y1 = x0[sloped], y0[sloped], x1[sloped], y1[sloped]
+    direction = np.where(y1 > y0, 1, -1)
+
+    # Where does each edge cross each row of pixel centres?
+    ys = bottom + np.arange(height)[:, None] + 0.5
+    crosses = (ys >= np.minimum(y0, y1)) & (ys < np.maximum(y0, y1))
+    rows, which = np.nonzero(crosses)
+    xs = x0[which] + (ys[rows, 0] - y0[which]) * (x1[which] - x0[which]) / (
+        y1[which] - y0[which]
+    )
+    # Each crossing changes the winding number of every pixel centre to its
+    # right; sum those changes along each row.
+    columns = np.clip(np.ceil(xs - left - 0.5).astype(int), 0, width)
+    winding = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(winding, (rows, columns), direction[which])
+    return np.cumsum(winding, axis=1)[:, :width] != 0, (left, bottom)
+
+
+class GlyphRasterizer:
+    """Renders shaped buffers from one HarfBuzz font as pixel coverage.
+
+    Args:
+        hbfont: The ``hb.Font`` to draw glyphs with.
+        scale: Pixels per font unit.
+    """
+
+    def __init__(self, hbfont, scale=0.125):
+        self.hbfont = hbfont
+        self.scale = scale
+        self.glyphs = {}
+
+    def glyph(self, gid):
+        """Returns a glyph's raster and the offset of its corner, in pixels."""
+        if gid not in self.glyphs:
+            pen = FlatteningPen()
+            self.hbfont.draw_glyph_with_pen(gid, pen)
+            edges = np.array(pen.edges, dtype=float).reshape(-1, 4) * self.scale
+            self.glyphs[gid] = fill(edges)
+        return self.glyphs[gid]
+
+    def placements(self, buf):
+        """Yields (raster, left, bottom) for each glyph of a buffer."""
+        x_cursor = y_cursor = 0
+        for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+            x_offset, y_offset, x_advance, y_advance = pos.position
+            raster, (left, bottom) = self.glyph(info.codepoint)
+            if raster.size:
+                yield (
+                    raster,
+                    left + round((x_cursor + x_offset) * self.scale),
+                    bottom + round((y_cursor + y_offset) * self.scale),
+                )
+            x_cursor += x_advance
+            y_cursor += y_advance
+
+    @staticmethod
+    def bounds(placements):
+        if not placements:
+            return (0, 0, 0, 0)
+        return (
+            min(left for _, left, _ in placements),
+            min(bottom for _, _, bottom in placements),
+            max(left + raster.shape[1] for raster, left, _ in placements),
+            max(bottom + raster.shape[0] for raster, _, bottom in placements),
+        )
+
+    @staticmethod
+    def draw(placements, frame):
+        left, bottom, right, top = frame
+        canvas = np.zeros((top - bottom, right - left), dtype=bool)
+        for raster, x, y in placements:
+            x -= left
+            y -= bottom
+            canvas[y : y + raster.shape[0], x : x + raster.shape[1]] |= raster
+        return canvas
+
+    def render(self, buf):
+        """Returns a buffer's rendering as a boolean array."""
+        placements = list(self.placements(buf))
+        return self.draw(placements, self.bounds(placements))
+
+    def visual_diffs(self, pairs, other=None):
+        """Scores how different each pair of buffers looks.
+
+        The second buffer of each pair is drawn with ``other`` (another
+        ``GlyphRasterizer``, e.g. for a different font), or with this one.
+        The score is the total difference in ink (0-255 per pixel) over
+        the area of the pair's frame, times 100."""
+        other = other or self
+        frames = []
+        for buf1, buf2 in pairs:
+            placed1 = list(self.placements(buf1))
+            placed2 = list(other.placements(buf2))
+            frames.append((placed1, placed2, self.bounds(placed1 + placed2)))
+        if not frames:
+            return np.zeros(0)
+        height = max(top - bottom for _, _, (_, bottom, _, top) in frames)
+        width = max(right - left for _, _, (left, _, right, _) in frames)
+        stack1 = np.zeros((len(frames), height, width), dtype=bool)
+        stack2 = np.zeros((len(frames), height, width), dtype=bool)
+        areas = np.zeros(len(frames))
+        for ix, (placed1, placed2, frame) in enumerate(frames):
+            left, bottom, right, top = frame
+            stack1[ix, : top - bottom, : right - left] = self.draw(placed1, frame)
+            stack2[ix, : top - bottom, : right - left] = self.draw(placed2, frame)
+            areas[ix] = max((top - bottom) * (right - left), 1)
+        differing = np.count_nonzero(stack1 != stack2, axis=(1, 2))
+        return differing * 255 / areas * 100
@@ -0,0 +1,48 @@
+"""Remembering which strings have been seen, cheaply."""
+import hashlib
+from array import array
+
+
+class SeenStrings:
+    """A set of strings, remembered only by 64-bit hashes packed in an array.
+
+    Samplers and fuzzers can go through millions of strings; this keeps
+    the cost of spotting repeats to eight bytes or so for each of them.
+    """
+
+    def __init__(self, capacity=1024):
+        self.slots = array("Q", bytes(8 * capacity))
+        self.count = 0
+
+    @staticmethod
+    def _hash(string):
+        digest = hashlib.blake2b(string.encode(), digest_size=8).digest()
+        # Zero marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def _slot(self, h):
+        mask = len(self.slots) - 1
+        ix = h & mask
+        while self.slots[ix] and self.slots[ix] != h:
+            ix = (ix + 1) & mask
+        return ix
+
+    def __contains__(self, string):
+        h = self._hash(string)
+        return self.slots[self._slot(h)] == h
+
+    def add(self, string):
+        """Adds a string, returning False if it was already there."""
+        h = self._hash(string)
+        ix = self._slot(h)
+        if self.slots[ix] == h:
+            return False
+        self.slots[ix] = h
+        self.count += 1
+        if self.count * 2 > len(self.slots):
+            old = self.slots
+            self.slots = array("Q", bytes(16 * len(old)))
+            for h in old:
+                if h:
+                    self.slots[self._slot(h)] = h
+        return True
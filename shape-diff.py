@@ -1,19 +1,213 @@
 from vharfbuzz import Vharfbuzz
-import sys
+import uharfbuzz as hb
+from argparse import ArgumentParser
+from itertools import islice
+from multiprocessing import Pool
+import hashlib
+import json
 
-font1 = Vharfbuzz(sys.argv[1])
-font2 = Vharfbuzz(sys.argv[2])
+CHUNK_SIZE = 100
 
-text = sys.argv[3]
 
-history1 = []
-history2 = []
-def onchange1(font, stage, lookupid, buf):
-	global history1
-	history1.append((stage,lookupid, buf))
-def onchange2(font, stage, lookupid, buf):
-	global history2
-	history2.append((stage,lookupid, buf))
+class Tracer:
+	"""Shapes texts with one font, watching each lookup which changes the buffer.
+
+	Keeping a copy of the buffer after every lookup costs lookups x glyphs,
+	so a trace only records the stage, lookup ID and a hash of the buffer
+	for each change. Buffers are rebuilt, by shaping again, only where
+	they are needed.
+	"""
+
+	def __init__(self, filename):
+		self.vharfbuzz = Vharfbuzz(filename)
+		self.hbfont = self.vharfbuzz.hbfont
+		self.names = {}
+
+	def name(self, gid):
+		if gid not in self.names:
+			self.names[gid] = self.hbfont.glyph_to_string(gid)
+		return self.names[gid]
+
+	def contents(self, buf, stage):
+		# As (glyph name, cluster, position) lists, with positions only once
+		# they mean something
+		if stage != "GPOS":
+			return [[self.name(info.codepoint), info.cluster, None] for info in buf.glyph_infos]
+		outs = []
+		for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+			outs.append([self.name(info.codepoint), info.cluster, pos.position])
+		return outs
+
+	def hash(self, buf, stage):
+		return hashlib.blake2b(repr(self.contents(buf, stage)).encode(), digest_size=16).digest()
+
+	def trace(self, text, visit):
+		"""Shapes a text, calling visit(index, stage, lookupid, buf) after each change."""
+		buf = hb.Buffer()
+		buf.add_str(text)
+		buf.guess_segment_properties()
+		state = {"stage": "GSUB", "before": None, "changes": 0}
+
+		def snapshot():
+			glyphs = [(info.codepoint, info.cluster) for info in buf.glyph_infos]
+			if state["stage"] == "GPOS":
+				return glyphs, [tuple(pos.position) for pos in buf.glyph_positions]
+			return glyphs
+
+		# Older uharfbuzz passes the buffer as well as the message
+		def message(msg, *args):
+			if msg.startswith("start table GPOS") or msg.startswith("start GPOS stage"):
+				state["stage"] = "GPOS"
+			elif msg.startswith("start lookup"):
+				state["before"] = snapshot()
+			elif msg.startswith("end lookup"):
+				if snapshot() != state["before"]:
+					visit(state["changes"], state["stage"], int(msg.split()[2]), buf)
+					state["changes"] += 1
+			return True
+
+		buf.set_message_func(message)
+		hb.shape(self.hbfont, buf)
+		return buf
+
+	def hashes(self, text):
+		"""Returns (stage, lookupid, hash) for each change, and a hash of the result."""
+		history = []
+		def visit(index, stage, lookupid, buf):
+			history.append((stage, lookupid, self.hash(buf, stage)))
+		final = self.trace(text, visit)
+		return history, self.hash(final, "GPOS")
+
+	def buffer_at(self, text, index, each=None):
+		"""Returns the buffer's contents after the given change (or at the end).
+
+		``each`` is called with the index, stage, lookup ID and contents of
+		every change before that one."""
+		found = []
+		def visit(i, stage, lookupid, buf):
+			if i < index and each:
+				each(i, stage, lookupid, self.contents(buf, stage))
+			elif i == index:
+				found.append(self.contents(buf, stage))
+		final = self.trace(text, visit)
+		if found:
+			return found[0]
+		return self.contents(final, "GPOS")
+
+
+def first_divergence(history1, history2):
+	"""Returns the index of the first change which differs between two traces."""
+	for index, (h1, h2) in enumerate(zip(history1, history2)):
+		if h1[2] != h2[2]:
+			return index
+	return min(len(history1), len(history2))
+
+
+def divergence(history1, history2):
+	"""Describes where two traces part as (stage1, lookup1, stage2, lookup2).
+
+	The lookups are None where one font made no more changes, and the whole
+	thing is None if the lookups agree throughout."""
+	index = first_divergence(history1, history2)
+	h1 = history1[index] if index < len(history1) else (None, None)
+	h2 = history2[index] if index < len(history2) else (None, None)
+	if h1[0] is None and h2[0] is None:
+		return None
+	return (h1[0], h1[1], h2[0], h2[1])
+
+
+def describe(where):
+	if where is None:
+		return "no lookup (glyph metrics, normalization...)"
+	stage1, lookup1, stage2, lookup2 = where
+	font1 = "%s lookup %i" % (stage1, lookup1) if stage1 else "no change"
+	font2 = "%s lookup %i" % (stage2, lookup2) if stage2 else "no change"
+	return "%s (font1) / %s (font2)" % (font1, font2)
+
+
+def read_words(filename):
+	"""Yields the distinct words in a word list or in compare_shape.py output."""
+	seen = set()
+	with open(filename, "r") as fh:
+		for line in fh:
+			line = line.strip()
+			if line.startswith("{"):
+				# compare_shape.py --jsonl: failures, or groups of them
+				entry = json.loads(line)
+				words = [entry["word"]] if "word" in entry else entry.get("examples", [])
+			elif line.startswith("Shaping "):
+				words = [line[len("Shaping "):]]
+			elif line.startswith("With ") or line.endswith(" failing"):
+				continue
+			else:
+				words = line.split()
+			for word in words:
+				if word not in seen:
+					seen.add(word)
+					yield word
+
+
+def chunked(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(islice(iterator, size))
+		if not chunk:
+			return
+		yield chunk
+
+
+# Each worker process (or the main process, when running serially) has its
+# own pair of tracers.
+tracers = None
+
+
+def init_tracers(file1, file2):
+	global tracers
+	tracers = (Tracer(file1), Tracer(file2))
+
+
+def diff_chunk(words):
+	"""Returns (word, divergence) for each word the fonts shape differently."""
+	results = []
+	for word in words:
+		history1, final1 = tracers[0].hashes(word)
+		history2, final2 = tracers[1].hashes(word)
+		if final1 != final2:
+			results.append((word, divergence(history1, history2)))
+	return len(words), results
+
+
+def batch(args):
+	initargs = (args.font1, args.font2)
+	chunks = chunked(read_words(args.words), CHUNK_SIZE)
+	pool = None
+	if args.jobs > 1:
+		pool = Pool(args.jobs, initializer=init_tracers, initargs=initargs)
+		results = pool.imap(diff_chunk, chunks)
+	else:
+		init_tracers(*initargs)
+		results = map(diff_chunk, chunks)
+
+	tested = 0
+	groups = {}
+	for count, differences in results:
+		tested += count
+		for word, where in differences:
+			if where not in groups:
+				groups[where] = [0, []]
+			groups[where][0] += 1
+			if len(groups[where][1]) < args.examples:
+				groups[where][1].append(word)
+	if pool:
+		pool.close()
+
+	failed = sum(count for count, _ in groups.values())
+	print("%i words, %i shaped differently" % (tested, failed))
+	if failed:
+		print("First differences:")
+	for where, (count, examples) in sorted(groups.items(), key=lambda group: -group[1][0]):
+		print("  %i x %s  e.g. %s" % (count, describe(where), " ".join(examples)))
+
 
 def poskey(pos):
 	skey = ""
@@ -27,18 +221,59 @@ def poskey(pos):
 def key(buf):
 	return "|".join(["%s=%i%s" % (b[0],b[1], poskey(b[2])) for b in buf])
 
-font1.shape(text, onchange=onchange1)
-font2.shape(text, onchange=onchange2)
-if history1[-1][2] != history2[-1][2]:
+
+def main():
+	parser = ArgumentParser(description="Find the lookup where two fonts' shaping parts ways")
+	parser.add_argument("font1", help="First font", metavar="FONT1")
+	parser.add_argument("font2", help="Second font", metavar="FONT2")
+	parser.add_argument("text", help="Text to shape", metavar="TEXT", nargs="?")
+	parser.add_argument(
+		"--words",
+		help="Instead of one text, trace each word in a word list (or compare_shape.py output)"
+		" and count where the differences start",
+		metavar="FILE",
+	)
+	parser.add_argument("--jobs", "-j", help="Number of worker processes (default: 1)", type=int, default=1)
+	parser.add_argument("--examples", help="Example words to show for each lookup pair (default: 3)", type=int, default=3)
+	args = parser.parse_args()
+	if args.words:
+		batch(args)
+		return
+	if args.text is None:
+		parser.error("give a text, or a word list with --words")
+
+	font1 = Tracer(args.font1)
+	font2 = Tracer(args.font2)
+
+	text = args.text
+
+	history1, final1 = font1.hashes(text)
+	history2, final2 = font2.hashes(text)
+	if final1 == final2:
+		print("✔ No differences")
+		return
+
+	index = first_divergence(history1, history2)
 	print("   font1⮯ ⮮font2")
-	for h1, h2 in zip(history1, history2):
-		if h1[2] == h2[2]:
-			print("✔ %s(%2i/%2i)  %s" % (h1[0], h1[1], h2[1], key(h1[2])))
-		else:
-			print("")
-			print("First difference appeared at %s lookup %i (font1) / %i (font2)" % (h1[0], h1[1],h2[1]))
-			print("font1          %s " % key(h1[2]))
-			print("font2          %s " % key(h2[2]))
-			break
-else:
-	print("✔ No differences")
+	def same(i, stage, lookupid, contents):
+		print("✔ %s(%2i/%2i)  %s" % (stage, lookupid, history2[i][1], key(contents)))
+	buf1 = font1.buffer_at(text, index, each=same)
+	buf2 = font2.buffer_at(text, index)
+	print("")
+	if index < len(history1) and index < len(history2):
+		h1, h2 = history1[index], history2[index]
+		print("First difference appeared at %s lookup %i (font1) / %i (font2)" % (h1[0], h1[1],h2[1]))
+	elif index >= len(history2) and index >= len(history1):
+		print("The lookups agree; the difference comes from elsewhere (glyph metrics, normalization...)")
+	elif index < len(history1):
+		h1 = history1[index]
+		print("First difference appeared at %s lookup %i (font1); font2 made no more changes" % (h1[0], h1[1]))
+	else:
+		h2 = history2[index]
+		print("First difference appeared at %s lookup %i (font2); font1 made no more changes" % (h2[0], h2[1]))
+	print("font1          %s " % key(buf1))
+	print("font2          %s " % key(buf2))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,225 @@
+"""A persistent, on-disk cache of shaping results.
+
+Results are keyed on a hash of the font tables which affect shaping, the
+HarfBuzz version, the text and the shaping parameters, so they stay valid
+across runs and across rebuilds of the font which don't touch its layout.
+They live in a small SQLite database which is trimmed, least recently used
+first, once it grows beyond a size limit.
+
+    cache = ShapingCache()
+    shaper = CachedShaper(Vharfbuzz("MyFont.ttf"), cache)
+    buf = shaper.shape("Hello", {"features": {"liga": False}})
+"""
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+import uharfbuzz as hb
+from fontTools.ttLib import TTFont
+from vharfbuzz import FakeBuffer, FakeItem
+
+# Tables HarfBuzz doesn't read when shaping. Everything else (layout,
+# metrics, outlines for fallback positioning and extents, variations...) is
+# hashed. (head is left out because its timestamps change on every build;
+# the upem is hashed separately.)
+IGNORED_TABLES = {
+    "head",
+    "name",
+    "post",
+    "DSIG",
+    "STAT",
+    "meta",
+    "gasp",
+    "prep",
+    "fpgm",
+    "cvt ",
+    "hdmx",
+    "LTSH",
+    "VDMX",
+    "Debg",
+    "FFTM",
+}
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# Approximate bookkeeping cost of a row, on top of its glyph data
+ROW_OVERHEAD = 64
+COMMIT_EVERY = 1000
+
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base, "font-engineering", "shaping-cache.sqlite")
+
+
+def shaping_tables(font):
+    """Tags of the tables in a font which can change shaping output."""
+    return [tag for tag in sorted(font.reader.keys()) if tag not in IGNORED_TABLES]
+
+
+def font_hash(filename):
+    """Hashes the parts of a font binary which can change shaping output."""
+    font = TTFont(filename, lazy=True)
+    digest = hashlib.sha256(hb.version_string().encode())
+    digest.update(str(font["head"].unitsPerEm).encode())
+    for tag in shaping_tables(font):
+        digest.update(tag.encode())
+        digest.update(font.reader[tag])
+    font.close()
+    return digest.hexdigest()
+
+
+def encode_buf(buf):
+    glyphs = array("i")
+    for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+        glyphs.extend([info.codepoint, info.cluster, *pos.position])
+    return glyphs.tobytes()
+
+
+def decode_buf(data):
+    """Turns stored glyph data back into a buffer-like object.
+
+    Like the result of ``Vharfbuzz.buf_from_string``, this can be serialized,
+    drawn or collision-checked as if it were a ``hb.Buffer``.
+    """
+    glyphs = array("i")
+    glyphs.frombytes(data)
+    buf = FakeBuffer()
+    buf.glyph_infos = []
+    buf.glyph_positions = []
+    for i in range(0, len(glyphs), 6):
+        info = FakeItem()
+        info.codepoint, info.cluster = glyphs[i : i + 2]
+        buf.glyph_infos.append(info)
+        pos = FakeItem()
+        pos.position = list(glyphs[i + 2 : i + 6])
+        pos.x_offset, pos.y_offset, pos.x_advance, pos.y_advance = pos.position
+        buf.glyph_positions.append(pos)
+    return buf
+
+
+class ShapingCache:
+    """A shaping result store shared by every tool and every run.
+
+    Args:
+        path: Database file (default: ``~/.cache/font-engineering/``).
+        max_size: Approximate size in bytes beyond which the least
+            recently used results are thrown away.
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        path = Path(path or default_cache_path())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Several processes may share the cache; WAL lets them read while
+        # another one writes.
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results"
+            " (key BLOB PRIMARY KEY, glyphs BLOB, used INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.max_size = max_size
+        self._used = set()
+        self._pending = 0
+        atexit.register(self.close)
+
+    @staticmethod
+    def key(fonthash, text, parameters):
+        parameters = json.dumps(parameters or {}, sort_keys=True)
+        return hashlib.sha256(
+            "\0".join([fonthash, text, parameters]).encode()
+        ).digest()
+
+    def get(self, fonthash, text, parameters):
+        """Returns a buffer-like object, or None if this wasn't cached."""
+        key = self.key(fonthash, text, parameters)
+        row = self.db.execute(
+            "SELECT glyphs FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        # Recency is written back in bulk, not on every hit
+        self._used.add(key)
+        return decode_buf(row[0])
+
+    def put(self, fonthash, text, parameters, buf):
+        key = self.key(fonthash, text, parameters)
+        self.db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            (key, encode_buf(buf), time.time_ns()),
+        )
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        if self._used:
+            now = time.time_ns()
+            self.db.executemany(
+                "UPDATE results SET used = ? WHERE key = ?",
+                [(now, key) for key in self._used],
+            )
+            self._used = set()
+        self.evict()
+        self.db.commit()
+        self._pending = 0
+
+    def size(self):
+        glyph_bytes, rows = self.db.execute(
+            "SELECT TOTAL(LENGTH(glyphs)), COUNT(*) FROM results"
+        ).fetchone()
+        return int(glyph_bytes) + rows * ROW_OVERHEAD
+
+    def evict(self):
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+        # Trim a little further than needed so we don't evict on every commit
+        excess += self.max_size // 10
+        doomed = []
+        for key, length in self.db.execute(
+            "SELECT key, LENGTH(glyphs) FROM results ORDER BY used"
+        ):
+            if excess <= 0:
+                break
+            doomed.append((key,))
+            excess -= length + ROW_OVERHEAD
+        self.db.executemany("DELETE FROM results WHERE key = ?", doomed)
+
+    def close(self):
+        if self.db is None:
+            return
+        self.commit()
+        self.db.close()
+        self.db = None
+
+
+class CachedShaper:
+    """Wraps a Vharfbuzz object so that shaping goes through a ShapingCache.
+
+    Args:
+        vharfbuzz: The ``Vharfbuzz`` object to shape with on a cache miss.
+        cache: A ``ShapingCache``, or None to always shape.
+    """
+
+    def __init__(self, vharfbuzz, cache):
+        self.vharfbuzz = vharfbuzz
+        self.cache = cache
+        self.fonthash = font_hash(vharfbuzz.filename) if cache else None
+
+    def shape(self, text, parameters=None):
+        if self.cache is None:
+            return self.vharfbuzz.shape(text, parameters)
+        buf = self.cache.get(self.fonthash, text, parameters)
+        if buf is not None:
+            # Vharfbuzz only serializes positions once it has seen shaping
+            # reach GPOS, which won't happen if everything comes from here.
+            self.vharfbuzz.stage = "GPOS"
+            return buf
+        buf = self.vharfbuzz.shape(text, parameters)
+        self.cache.put(self.fonthash, text, parameters, buf)
+        return buf
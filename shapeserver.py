@@ -0,0 +1,38 @@
+"""Shapes texts for another process, using whichever uharfbuzz this Python has.
+
+Run by ``shapingbackends.ShapingBackend`` with a different interpreter, to
+compare HarfBuzz builds. Only needs uharfbuzz. Reads one JSON list of texts
+per line on stdin, and answers each with a JSON list of shaped glyphs, each
+buffer packed as hex in the same layout as ``shapecache.encode_buf``.
+
+    python3 shapeserver.py FONT SHAPER
+"""
+import json
+import sys
+from array import array
+import uharfbuzz as hb
+
+
+def main():
+    font, shaper = sys.argv[1:3]
+    with open(font, "rb") as fontfile:
+        face = hb.Face(fontfile.read())
+    hbfont = hb.Font(face)
+    buf = hb.Buffer()
+    print(json.dumps({"version": hb.version_string()}), flush=True)
+    for line in sys.stdin:
+        results = []
+        for text in json.loads(line):
+            buf.clear_contents()
+            buf.add_str(text)
+            buf.guess_segment_properties()
+            hb.shape(hbfont, buf, shapers=[shaper])
+            glyphs = array("i")
+            for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
+                glyphs.extend([info.codepoint, info.cluster, *pos.position])
+            results.append(glyphs.tobytes().hex())
+        print(json.dumps(results), flush=True)
+
+
+if __name__ == "__main__":
+    main()
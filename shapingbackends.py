@@ -0,0 +1,108 @@
+"""Shapers to compare against each other.
+
+A backend shapes texts with one font and one HarfBuzz shaper (``ot``,
+``fallback``, ``coretext``...). Shaping normally happens in this process;
+given another Python interpreter, it is done by a child process running
+``shapeserver.py`` under that interpreter instead, so two builds of
+HarfBuzz (two installs of uharfbuzz) can be compared. Either way the
+font's outlines are drawn with this process's HarfBuzz.
+
+    backend1 = ShapingBackend("MyFont.ttf", "ot")
+    backend2 = ShapingBackend("MyFont.ttf", "ot", python="/opt/hb-old/bin/python3")
+    bufs1 = backend1.shape_batch(["abc", "def"])
+"""
+import json
+import subprocess
+from pathlib import Path
+import numpy as np
+from vharfbuzz import Vharfbuzz
+from shapecache import decode_buf
+
+
+class ShapingBackend:
+    """Shapes texts with a given font, shaper and (optionally) Python.
+
+    Args:
+        font: The font file.
+        shaper: The HarfBuzz shaper to use.
+        python: Another Python interpreter to shape with, or None.
+    """
+
+    def __init__(self, font, shaper="ot", python=None):
+        self.vharfbuzz = Vharfbuzz(font)
+        self.vharfbuzz.shapers = [shaper]
+        self.label = shaper
+        self.process = None
+        if python:
+            self.process = subprocess.Popen(
+                [python, str(Path(__file__).parent / "shapeserver.py"), font, shaper],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding="utf-8",
+            )
+            version = json.loads(self.process.stdout.readline())["version"]
+            self.label = f"{shaper} (HarfBuzz {version})"
+        try:
+            self.shape_batch(["a"])
+        except Exception:
+            self.close()
+            raise ValueError(f"The {shaper} shaper is not available") from None
+
+    def shape_batch(self, texts):
+        """Returns a buffer (or something which looks like one) per text."""
+        if not self.process:
+            return [self.vharfbuzz.shape(text) for text in texts]
+        self.process.stdin.write(json.dumps(texts) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("Shaping process failed")
+        # Buffers which didn't come from Vharfbuzz.shape need this to
+        # serialize their positions
+        self.vharfbuzz.stage = "GPOS"
+        return [decode_buf(bytes.fromhex(glyphs)) for glyphs in json.loads(line)]
+
+    def serialize(self, buf):
+        self.vharfbuzz.stage = "GPOS"
+        return self.vharfbuzz.serialize_buf(buf)
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+
+def glyph_array(buf):
+    """A buffer's glyph IDs, x and y offsets and x advances as an (n, 4) array."""
+    return np.array(
+        [
+            (info.codepoint, *pos.position[:3])
+            for info, pos in zip(buf.glyph_infos, buf.glyph_positions)
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 4)
+
+
+def buffers_differ_batch(pairs, tolerance=2):
+    """Returns which pairs of buffers have different glyphs or positions.
+
+    A pair differs if it has different numbers of glyphs, any glyph
+    differs, or an offset or advance differs by more than ``tolerance``.
+    All the pairs of the same length are checked in one go."""
+    arrays1 = [glyph_array(buf1) for buf1, _ in pairs]
+    arrays2 = [glyph_array(buf2) for _, buf2 in pairs]
+    lengths = np.array([len(a) for a in arrays1], dtype=np.int64)
+    differ = lengths != np.array([len(a) for a in arrays2], dtype=np.int64)
+    same = np.nonzero(~differ & (lengths > 0))[0]
+    if not len(same):
+        return differ
+    glyphs1 = np.concatenate([arrays1[ix] for ix in same])
+    glyphs2 = np.concatenate([arrays2[ix] for ix in same])
+    bad = (glyphs1[:, 0] != glyphs2[:, 0]) | (
+        np.abs(glyphs1[:, 1:] - glyphs2[:, 1:]) > tolerance
+    ).any(axis=1)
+    starts = np.concatenate([[0], np.cumsum(lengths[same])[:-1]])
+    differ[same] = np.add.reduceat(bad, starts) > 0
+    return differ